@@ -43,6 +43,7 @@ def main():
     import argparse
     from importlib import import_module
     import time
+    import sqlite3
     import logging
     import logging.config
     if sys.version_info.major < 3 and sys.version_info.minor < 5:
@@ -104,7 +105,8 @@ def main():
 
     basic = parser.add_argument_group('basic', 'Basic commands')
     basic.add_argument('-o', '--outdir',metavar="", default=".",                    help="Output directory")
-    basic.add_argument("--dump", action='store_true',                               help="Write database to names.dmp and nodes.dmp")
+    basic.add_argument("--dump", action='store_true',                               help="Write database to names.dmp and nodes.dmp (skipped if the database is unchanged since the last dump, see --dump_untracked)")
+    basic.add_argument("--dump_binary", action='store_true',                        help="Write database to a memory mappable binary taxonomy (taxonomy.ftb), see modules/BinaryTaxonomy.py")
     basic.add_argument('--dump_mini', action='store_true',                          help="Dump minimal file with tab as separator")
     basic.add_argument("--force", action='store_true',                              help="use when script is implemented in pipeline to avoid security questions on overwrite!")
     basic.add_argument('--validate', action='store_true',                           help="Validate database format")
@@ -115,6 +117,9 @@ def main():
     read_opts.add_argument('-tf', '--taxonomy_file',metavar="", default=None,                   help="Taxonomy source file")
     read_opts.add_argument('-tt', '--taxonomy_type',metavar="", default="", choices=rmodules,   help="Source format of taxonomy input file ({modules})".format(modules=",".join(rmodules)))
     read_opts.add_argument('--taxid_base', metavar="", type=int, default=1,                     help="The base for internal taxonomy ID numbers, when using NCBI as base select base at minimum 3000000 (default = 1)")
+    read_opts.add_argument('--staging', metavar="", default=False,                              help="Build or modify the database in memory (memory) or in a given directory (e.g. /dev/shm), the database file is written once complete (python 3.7+)")
+    read_opts.add_argument('--fast_import', '--fast-import', action='store_true', default=False, help="Turn off journaling and syncing while the database is created, durable settings are restored when the import is done")
+    read_opts.add_argument('--processes', metavar="", type=int, default=1,                      help="Number of processes used to parse QIIME/GTDB taxonomy files and threads used to compress the genomes dump (default = 1)")
 
     mod_opts = parser.add_argument_group('mod_opts', "Database modification options")
     mod_opts.add_argument('-mf','--mod_file', metavar="", default=False,                help="File contaning modifications parent,child,(taxonomy level)")
@@ -131,6 +136,7 @@ def main():
     mod_opts.add_argument('--refdatabase', metavar="", default=False,                   help="For download command, give value of expected source, default (refseq)")
     mod_opts.add_argument('--purge_database','--purge_db',metavar='',default=False,                  help="Used to purge the FlexTaxD-database from entries that lack a downloaded genome (such as when creating a GTDB-database using all taxonomy but using just the representative dataset)\nProvide the directory path of the downloaded genomes (default = FALSE)")
     mod_opts.add_argument('--purge_database_force','--purge_db_force', action='store_true',default=False,   help="If specified, will remove all genomes that are missing from the FlexTaxD-database, regardless if they are distinct nodes or not in the tree (default = FALSE)")
+    mod_opts.add_argument('--closure_table', action='store_true', default=False,          help="Build (or rebuild) the tree closure table, ancestry lookups become indexed queries and the table is kept updated on modification")
 
 
     out_opts = parser.add_argument_group('output_opts', "Output options")
@@ -138,8 +144,11 @@ def main():
     out_opts.add_argument("--dump_prefix", metavar="", default="names,nodes",                       help="change dump prefix reqires two names default(names,nodes)")
     out_opts.add_argument('--dump_sep', metavar="", default="\t|\t",                                help="Set output separator default(NCBI) also adds extra trailing columns for kraken")
     out_opts.add_argument('--dump_descriptions', action='store_true', default=False,                help="Dump description names instead of database integers")
+    out_opts.add_argument('--dump_untracked', action='store_true', default=False,                   help="Always write the dump and remove the change tracking triggers that --dump installs to skip unchanged dumps")
+    out_opts.add_argument('--dump_gzip', action='store_true', default=False,                        help="Compress names.dmp and nodes.dmp (and genomes.dmp) with gzip while they are written (.dmp.gz)")
     out_opts.add_argument('--dump_genomes', action='store_true', default=False,                     help="Print list of genomes (and source) to file")
     out_opts.add_argument('--dump_genome_annotations', action='store_true', default=False,          help="Add genome taxid annotation to genomes dump")
+    out_opts.add_argument('--dump_genomes_unsorted', action='store_true', default=False,            help="Write genomes in database order instead of sorted by reference")
 
     vis_opts = parser.add_argument_group('vis_opts', "Visualisation options")
     vis_opts.add_argument('--vis_node','--visualise_node', metavar='', default=False,                            help="Visualise tree from selected node")
@@ -206,6 +215,12 @@ def main():
     if args.force:
         force = True
 
+    staging = False
+    if args.staging:
+        if not hasattr(sqlite3.Connection,"backup"):
+            raise InputError("--staging requires python 3.7 or later (sqlite3 backup)")
+        staging = ":memory:" if args.staging == "memory" else args.staging
+
 
     ### Run pipeline
 
@@ -273,8 +288,9 @@ def main():
         else:
             ncbi=False
         modify_module = dynamic_import("modules", "ModifyTree")
-        modify_obj = modify_module(database=args.database,clean_database=args.clean_database,taxid_base=args.taxid_base)
+        modify_obj = modify_module(database=args.database,clean_database=args.clean_database,taxid_base=args.taxid_base,staging=staging)
         modify_obj.clean_database(ncbi=ncbi)
+        modify_obj.taxonomydb.persist()
     
     '''Purge database from entries that do not exist in --genomes_path [as known in flextaxd-create] directory'''
     if args.purge_database:
@@ -296,19 +312,21 @@ def main():
         # Send genomes to have their nodes (and parents, when loosing all their childs) removes
         if missing:
             modify_module = dynamic_import("modules", "ModifyTree")
-            modify_obj = modify_module(database=args.database,purge_database=True,taxid_base=args.taxid_base)
+            modify_obj = modify_module(database=args.database,purge_database=True,taxid_base=args.taxid_base,staging=staging)
             modify_obj.purge_database(missing_genomes,force_genome_delete=args.purge_database_force)
+            modify_obj.taxonomydb.persist()
         #/
 
     '''Dump option, export list of genomes, added in flextaxd version 0.4.2'''
     if args.dump_genomes:
         logger.info("Dump list of genomes")
         write_module = dynamic_import("modules", "WriteTaxonomy")
-        write_obj = write_module(args.outdir, database=args.database,prefix=args.dump_prefix,separator=args.dump_sep,minimal=args.dump_mini,desc=args.dump_descriptions,dbprogram=args.dbprogram,dump_genomes=True)
+        write_obj = write_module(args.outdir, database=args.database,prefix=args.dump_prefix,separator=args.dump_sep,minimal=args.dump_mini,desc=args.dump_descriptions,dbprogram=args.dbprogram,dump_genomes=True,compress=args.dump_gzip)
+        sort = False if args.dump_genomes_unsorted else "reference"
         if args.dump_genome_annotations:
-            write_obj.dump_genome_annotations()
+            write_obj.dump_genome_annotations(sort=sort,workers=args.processes)
         else:
-            write_obj.dump_genomes(genomes_list = genomes)
+            write_obj.dump_genomes(sort=sort,workers=args.processes)
 
     ''' 0. Create taxonomy database (if it does not exist)'''
     if args.taxonomy_file:
@@ -316,18 +334,23 @@ def main():
             '''Load taxonomy module'''
             logger.info("Loading module: ReadTaxonomy{type}".format(type=args.taxonomy_type))
             read_module = dynamic_import("modules", "ReadTaxonomy{type}".format(type=args.taxonomy_type))
-            read_obj = read_module(args.taxonomy_file, database=args.database,skip_annotation=args.skip_annotation)
-            logger.info("Parse taxonomy")
-            read_obj.parse_taxonomy()                                                           ## Parse taxonomy file
-
-            '''Parse genome2taxid file'''                                                       ## Fix at some point only one function should be needed
-            if not args.genomeid2taxid and not args.taxonomy_type == "QIIME":
-                logger.warning("Warning no genomeid2taxid file given!")
-
-            if args.taxonomy_type == "NCBI" and args.genomeid2taxid:
-                read_obj.parse_genomeid2taxid(args.genomes_path,args.genomeid2taxid)
-            elif args.genomeid2taxid: ## Always parse genomeid2taxid if present
-                read_obj.parse_genomeid2taxid(args.genomeid2taxid)
+            read_obj = read_module(args.taxonomy_file, database=args.database,skip_annotation=args.skip_annotation,fast_import=args.fast_import,staging=staging,processes=args.processes)
+            try:
+                logger.info("Parse taxonomy")
+                read_obj.parse_taxonomy()                                                       ## Parse taxonomy file
+
+                '''Parse genome2taxid file'''                                                   ## Fix at some point only one function should be needed
+                if not args.genomeid2taxid and not args.taxonomy_type == "QIIME":
+                    logger.warning("Warning no genomeid2taxid file given!")
+
+                if args.taxonomy_type == "NCBI" and args.genomeid2taxid:
+                    read_obj.parse_genomeid2taxid(args.genomes_path,args.genomeid2taxid)
+                elif args.genomeid2taxid: ## Always parse genomeid2taxid if present
+                    read_obj.parse_genomeid2taxid(args.genomeid2taxid)
+            finally:
+                if args.fast_import:                                                            ## Restore durable settings also when the import fails
+                    read_obj.database.set_fast_import(False)
+            read_obj.database.persist()
 
             logger.info("Nodes in taxonomy tree {n} number of taxonomies {k}".format(n=read_obj.length, k=read_obj.ids))
             current_time = report_time(current_time)
@@ -340,18 +363,20 @@ def main():
             logger.critical("No genomeid2taxid file given!")
         logger.info("Loading module: ModifyTree")
         modify_module = dynamic_import("modules", "ModifyTree")
-        modify_obj = modify_module(database=args.database, mod_file=args.mod_file, mod_database= args.mod_database,parent=args.parent,replace=args.replace,taxid_base=args.taxid_base)
+        modify_obj = modify_module(database=args.database, mod_file=args.mod_file, mod_database= args.mod_database,parent=args.parent,replace=args.replace,taxid_base=args.taxid_base,staging=staging)
         modify_obj.update_database()
         if args.mod_file:
             current_time = report_time(current_time)
             modify_obj.update_annotations(genomeid2taxid=args.genomeid2taxid)
+        modify_obj.taxonomydb.persist()
         current_time = report_time(current_time)
 
     '''Special, only add new genomes'''
     if args.genomeid2taxid and not (args.mod_file or args.mod_database or args.taxonomy_file):
         modify_module = dynamic_import("modules", "ModifyTree")
-        modify_obj = modify_module(database=args.database, update_genomes=True,taxid_base=args.taxid_base)
+        modify_obj = modify_module(database=args.database, update_genomes=True,taxid_base=args.taxid_base,staging=staging)
         modify_obj.update_annotations(genomeid2taxid=args.genomeid2taxid)
+        modify_obj.taxonomydb.persist()
 
     # if args.update_names:
     #     modify_module = dynamic_import("modules", "ModifyTree")
@@ -366,8 +391,16 @@ def main():
 
     if (args.mod_file or args.mod_database) and args.clean_database:
         modify_module = dynamic_import("modules", "ModifyTree")
-        modify_obj = modify_module(database=args.database,clean_database=args.clean_database,taxid_base=args.taxid_base)
+        modify_obj = modify_module(database=args.database,clean_database=args.clean_database,taxid_base=args.taxid_base,staging=staging)
         modify_obj.clean_database()
+        modify_obj.taxonomydb.persist()
+
+    '''Build the closure table once all imports and modifications are done'''
+    if args.closure_table:
+        from modules.database.DatabaseConnection import DatabaseFunctions
+        db = DatabaseFunctions(args.database)
+        db.build_closure()
+        current_time = report_time(current_time)
 
     ''' 2. Dump custom taxonomy database into NCBI/kraken readable format)'''
     if args.dump or args.dump_mini:
@@ -381,19 +414,24 @@ def main():
         '''Create print out object'''
         logger.info("Loading module: WriteTaxonomy".format(type=args.taxonomy_type))
         write_module = dynamic_import("modules", "WriteTaxonomy")
-        write_obj = write_module(args.outdir, database=args.database,prefix=args.dump_prefix,separator=args.dump_sep,minimal=args.dump_mini,desc=args.dump_descriptions,dbprogram=args.dbprogram)
+        write_obj = write_module(args.outdir, database=args.database,prefix=args.dump_prefix,separator=args.dump_sep,minimal=args.dump_mini,desc=args.dump_descriptions,dbprogram=args.dbprogram,compress=args.dump_gzip,track_changes=not args.dump_untracked)
 
         '''Print database to file'''
         if args.taxonomy_type == "NCBI":
             write_obj.set_minimal()
-        write_obj.nodes()
-        write_obj.names()
+        write_obj.dump()
         if False: #args.taxDB:
             write_obj.set_separator("\t")
             write_obj.set_prefix("names,taxDB")
             write_obj.set_order(True)
             write_obj.nodes()
 
+    if args.dump_binary:
+        logger.info("Dump binary taxonomy")
+        write_module = dynamic_import("modules", "WriteTaxonomy")
+        write_obj = write_module(args.outdir, database=args.database)
+        write_obj.dump_binary()
+
     if args.vis_node:
         modify_module = dynamic_import("modules", "NewickTree")
         modify_obj = modify_module(database=args.database,taxid=args.vis_node,maxdepth=args.vis_depth,label_size=args.vis_label_size,vis_clip_labels=args.vis_clip_labels)
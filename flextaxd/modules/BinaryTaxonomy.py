@@ -0,0 +1,209 @@
+#!/usr/bin/env python3 -c
+
+'''
+Binary columnar taxonomy format (.ftb), written by WriteTaxonomy.dump_binary
+
+All values are little-endian and every section starts on an 8 byte boundary, so the
+file can be memory mapped and the columns used in place without parsing or copying.
+
+	header        - magic, version, number of nodes and ranks, byte offset of each section
+	ids           - int32[nodes]     node ids (sorted)
+	parents       - int32[nodes]     parent id of each node (the root is its own parent, -1 if the node has no parent)
+	ranks         - int32[nodes]     rank_i of each node
+	rank_ids      - int32[ranks]     rank_i of the rank names
+	rank_offsets  - uint64[ranks+1]  start of each rank name in rank_names
+	rank_names    - utf-8 text
+	name_offsets  - uint64[nodes+1]  start of each node name in names
+	names         - utf-8 text
+'''
+
+from array import array
+from bisect import bisect_left
+import mmap
+import struct
+import sys
+import logging
+logger = logging.getLogger(__name__)
+
+MAGIC = b"FLEXTAXD"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQ8Q")  ## magic, version, reserved, nodes, ranks, section offsets
+
+class FormatError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
+
+def align(offset):
+	'''Round an offset up to the next 8 byte boundary'''
+	return (offset + 7) & ~7
+
+def write_array(outputfile, values, typecode):
+	'''Write values as a little-endian array at the next 8 byte boundary
+
+	------
+	Returns
+		int - offset of the array in the file
+	'''
+	column = values if isinstance(values, array) and values.typecode == typecode else array(typecode, values)
+	if sys.byteorder != "little":
+		column = array(typecode, column)
+		column.byteswap()
+	offset = align(outputfile.tell())
+	outputfile.seek(offset)
+	column.tofile(outputfile)
+	return offset
+
+def write_binary(path, ids, parents, ranks, names, rank_names):
+	'''Write a binary taxonomy file
+
+	Parameters
+		path       - output file
+		ids        - sorted node ids
+		parents    - parent id of each node
+		ranks      - rank_i of each node
+		names      - iterable of the node names in id order
+		rank_names - list of (rank_i, rank) pairs
+
+	------
+	Returns
+		int - number of nodes written
+	'''
+	nodes = len(ids)
+	with open(path, "wb") as outputfile:
+		outputfile.write(b"\0" * HEADER.size)
+		sections = [
+			write_array(outputfile, ids, "i"),
+			write_array(outputfile, parents, "i"),
+			write_array(outputfile, ranks, "i"),
+			write_array(outputfile, [rank_i for rank_i, rank in rank_names], "i"),
+		]
+		text = [rank.encode("utf-8") for rank_i, rank in rank_names]
+		offsets = array("Q", [0])
+		for rank in text:
+			offsets.append(offsets[-1] + len(rank))
+		sections.append(write_array(outputfile, offsets, "Q"))
+		sections.append(outputfile.tell())
+		outputfile.write(b"".join(text))
+		## The name offsets are only known once the names are written, reserve their space and write them last
+		name_offsets = align(outputfile.tell())
+		names_start = name_offsets + 8 * (nodes + 1)
+		outputfile.seek(names_start)
+		offsets = array("Q", [0])
+		for name in names:
+			name = name.encode("utf-8")
+			outputfile.write(name)
+			offsets.append(offsets[-1] + len(name))
+		if len(offsets) != nodes + 1:
+			raise FormatError("Got {n} names for {nodes} nodes".format(n=len(offsets) - 1, nodes=nodes))
+		outputfile.seek(name_offsets)
+		write_array(outputfile, offsets, "Q")
+		sections += [name_offsets, names_start]
+		outputfile.seek(0)
+		outputfile.write(HEADER.pack(MAGIC, VERSION, 0, nodes, len(rank_names), *sections))
+	return nodes
+
+class BinaryTaxonomy(object):
+	"""Memory mapped reader of a binary taxonomy file, the columns are memoryviews on the mapped file"""
+	def __init__(self, path):
+		super(BinaryTaxonomy, self).__init__()
+		self.path = path
+		with open(path, "rb") as inputfile:
+			self.mmap = mmap.mmap(inputfile.fileno(), 0, access=mmap.ACCESS_READ)
+		self.buffer = memoryview(self.mmap)
+		magic, version, reserved, self.size, self.nranks, *sections = HEADER.unpack_from(self.buffer)
+		if magic != MAGIC:
+			raise FormatError("{path} is not a FlexTaxD binary taxonomy".format(path=path))
+		if version != VERSION:
+			raise FormatError("Unsupported binary taxonomy version {version}".format(version=version))
+		ids, parents, ranks, rank_ids, rank_offsets, rank_names, name_offsets, names = sections
+		self.ids = self.column(ids, self.size, "i")
+		self.parents = self.column(parents, self.size, "i")
+		self.ranks = self.column(ranks, self.size, "i")
+		self.rank_ids = self.column(rank_ids, self.nranks, "i")
+		self.rank_offsets = self.column(rank_offsets, self.nranks + 1, "Q")
+		self.rank_names = rank_names
+		self.name_offsets = self.column(name_offsets, self.size + 1, "Q")
+		self.names = names
+		logger.debug("Loaded binary taxonomy {path} ({n} nodes)".format(path=path, n=self.size))
+
+	def column(self, offset, length, typecode):
+		'''Get a column of the file, a zero copy view on little-endian hosts'''
+		size = array(typecode).itemsize
+		view = self.buffer[offset:offset + length * size].cast(typecode)
+		if sys.byteorder != "little":
+			column = array(typecode, view)
+			column.byteswap()
+			view.release()
+			return column
+		return view
+
+	def close(self):
+		'''Release the views and the memory map'''
+		for view in (self.ids, self.parents, self.ranks, self.rank_ids, self.rank_offsets, self.name_offsets):
+			if isinstance(view, memoryview):
+				view.release()
+		self.buffer.release()
+		self.mmap.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __len__(self):
+		return self.size
+
+	def __contains__(self, node):
+		return self.row(node) >= 0
+
+	def row(self, node):
+		'''Get the row of a node id (-1 if the node is not in the file)'''
+		row = bisect_left(self.ids, node)
+		if row < self.size and self.ids[row] == node:
+			return row
+		return -1
+
+	def text(self, start, offsets, i):
+		'''Decode the i:th string of a text section'''
+		return bytes(self.buffer[start + offsets[i]:start + offsets[i + 1]]).decode("utf-8")
+
+	def name(self, node):
+		'''Get the name of a node (None if the node is not in the file)'''
+		row = self.row(node)
+		if row < 0:
+			return None
+		return self.text(self.names, self.name_offsets, row)
+
+	def parent(self, node):
+		'''Get the parent id of a node (None if the node has no parent)'''
+		row = self.row(node)
+		if row < 0 or self.parents[row] < 0:
+			return None
+		return self.parents[row]
+
+	def rank(self, node):
+		'''Get the rank name of a node'''
+		row = self.row(node)
+		if row < 0:
+			return None
+		i = bisect_left(self.rank_ids, self.ranks[row])
+		if i < self.nranks and self.rank_ids[i] == self.ranks[row]:
+			return self.text(self.rank_names, self.rank_offsets, i)
+		return None
+
+	def lineage(self, node):
+		'''Get the lineage of a node
+
+		------
+		Returns
+			list - node ids from the node up to the root
+		'''
+		lineage = []
+		while node is not None and node in self and len(lineage) <= self.size:
+			lineage.append(node)
+			parent = self.parent(node)
+			node = parent if parent != node else None
+		return lineage
@@ -55,7 +55,7 @@ class TreeError(Exception):
 
 class ModifyTree(object):
 	"""docstring for ModifyTree."""
-	def __init__(self, database=".taxonomydb", mod_database=False, mod_file=False, clean_database=False, purge_database=False,update_genomes=False, update_node_names=False,rename_node=False,separator="\t",verbose=False,parent=False,replace=False,**kwargs):
+	def __init__(self, database=".taxonomydb", mod_database=False, mod_file=False, clean_database=False, purge_database=False,update_genomes=False, update_node_names=False,rename_node=False,separator="\t",verbose=False,parent=False,replace=False,staging=False,**kwargs):
 		super(ModifyTree, self).__init__()
 		self.verbose = verbose
 		logger.info("Modify Tree")
@@ -73,7 +73,7 @@ class ModifyTree(object):
 		self.fast_clean = True
 
 		### Connect to or create database
-		self.taxonomydb = ModifyFunctions(database,verbose=verbose)
+		self.taxonomydb = ModifyFunctions(database,verbose=verbose,staging=staging)
 		self.rank= self.taxonomydb.get_rank(col=2)
 		## Save all nodes in the current database
 		self.nodeDict = self.taxonomydb.get_nodes()
@@ -188,7 +188,7 @@ class ModifyTree(object):
 		logger.debug(self.dbmod_annotation)
 		self.dbmod_rank = database.get_rank(col=1)
 		### Translate node ids between databases and add non existing nodes into current database
-		for link in database.get_links(database.get_children(set([database.get_id(parent)]))):
+		for link in database.get_links(set(database.iter_subtree([database.get_id(parent)]))):
 			link = list(link)
 			logger.debug(link)
 
@@ -266,7 +266,7 @@ class ModifyTree(object):
 		self.parent_link = self.taxonomydb.get_parent(self.taxonomydb.get_id(self.parent))
 		if not self.parent_link:
 			raise InputError("The selected parent node ({parent}) could not be found in the source database!".format(parent=self.parent))
-		self.existing_nodes = self.taxonomydb.get_children(set([self.taxonomydb.get_id(self.parent)])) ## - set([self.taxonomydb.get_id(self.parent)] )
+		self.existing_nodes = set(self.taxonomydb.iter_subtree([self.taxonomydb.get_id(self.parent)])) ## - set([self.taxonomydb.get_id(self.parent)] )
 		logger.info("{n} children to {parent}".format(n=len(self.existing_nodes),parent=self.parent))
 		if len(self.existing_nodes) > 0:
 			self.existing_links = set(self.taxonomydb.get_links(self.existing_nodes))
@@ -303,100 +303,82 @@ class ModifyTree(object):
 		'''Get all genomes annotated to new nodes in existing database'''
 		return True
 
-	def update_annotations(self, genomeid2taxid, reference=False):
-		'''Function that adds annotation of genome ids to nodes'''
-		logger.info("Update genome to taxid annotations using {genomeid2taxid}".format(genomeid2taxid=genomeid2taxid))
-		_ref = reference
-		update = {
-			"set_column": "id",
-			"where_column": "genome",
-			"set_value": "",
-			"where": ""
-		}
-		#if _ref:
-		#	update[""]
-		updated = 0
-		added = 0
+	def read_annotations(self, genomeid2taxid):
+		'''Read a genomeid2taxid file and resolve node names to ids using the cached nodeDict
+
+		------
+		Returns
+			iterator - (genome, id) rows
+		'''
+		debug = logger.isEnabledFor(logging.DEBUG)
 		with open(genomeid2taxid) as f:
 			for row in f:
+				row = row.strip()
+				if row == "":  ## If there are trailing empty lines in the file
+					continue
 				try:
-					if len(row.strip().split(self.sep)) > 2:
-						genome,name,reference = row.strip().split(self.sep)
+					if len(row.split(self.sep)) > 2:
+						genome,name,reference = row.split(self.sep)
 					else:
-						genome,name = row.strip().split(self.sep)
+						genome,name = row.split(self.sep)
 				except ValueError:
-					genome,name = row.strip().split("    ")
-				logger.debug("genome: {genome}, name: {name}".format(genome=genome,name=name))
+					genome,name = row.split("    ")
+				if debug:
+					logger.debug("genome: {genome}, name: {name}".format(genome=genome,name=name))
+				name = name.strip()
 				try:
-					if not self._is_int(name.strip()):
-						id = self.nodeDict[name.strip()]
+					if not self._is_int(name):
+						id = self.nodeDict[name]
 					else:
-						id = int(name.strip())
+						id = int(name)
 						## The input was already an index not a name, output warning or assume valid index?
-						logger.debug("# WARNING: Input was an index not a name, make sure indexes match the current database!")
-
+						if debug:
+							logger.debug("# WARNING: Input was an index not a name, make sure indexes match the current database!")
 				except KeyError:
 					logger.debug("# WARNING: there was no database entry for {name} annotation not updated for this entry!".format(name=name))
 				else:
-					## If no exception occured add genome
-					update["set_value"] = id
-					update["where"] = genome.strip()
-					res = self.taxonomydb.update_genome(update)
-					if self.taxonomydb.rowcount()!=0:
-						if res:
-							updated += 1
-						else:
-							added += 1
-		self.taxonomydb.commit()
-		gid = self.taxonomydb.get_genomes()
+					yield genome.strip(),id
+
+	def update_annotations(self, genomeid2taxid, reference=False):
+		'''Function that adds annotation of genome ids to nodes, annotations are added or updated in batches'''
+		logger.info("Update genome to taxid annotations using {genomeid2taxid}".format(genomeid2taxid=genomeid2taxid))
+		added,updated = self.taxonomydb.upsert_genomes(self.read_annotations(genomeid2taxid))  ## One transaction per batch
 		logger.info("{added} added and {updated} genome annotations were updated!".format(added=added, updated=updated))
+		if updated > 0:
+			logger.warning("{updated} genomes already in the database were moved to the node given in {genomeid2taxid}".format(updated=updated,genomeid2taxid=genomeid2taxid))
 		return
 
+	def translate_genomes(self):
+		'''Translate genome annotations of the incoming database to node ids in the taxonomydb
+
+		------
+		Returns
+			iterator - (id, genome) rows, genomes annotated to nodes missing in the taxonomydb are counted in self.notadded
+		'''
+		for genome in self.mod_genomes:
+			'''Translate incoming database node id to taxonomydb node id'''
+			inc_taxid = self.dbmod_annotation[self.mod_genomes[genome]].strip()
+			try:
+				yield self.nodeDict[inc_taxid],genome.strip()
+			except KeyError:  ## taxid does not exist in receiving database, skip genome
+				self.notadded +=1
+
 	def update_genomes(self):
 		'''When a database is supplied as source for the update genome annotations from that database needs to be transfered to the taxonomydb'''
+		self.notadded = 0
+		'''Database has been updated, so the internal nodeDict needs to be updated'''
+		self.nodeDict = self.taxonomydb.get_nodes()
 		update = {
 			"set_column": "id",
 			"where_column": "genome",
-			"set_value": "",
-			"where": ""
+			"data": self.translate_genomes()
 		}
-		updated = 0
-		added = 0
-		notadded = 0
-		'''Database has been updated, so the internal nodeDict needs to be updated'''
-		if len(self.mod_genomes) >= 100:
-			allupdates = []
-		self.nodeDict = self.taxonomydb.get_nodes()
-		for genome in self.mod_genomes:
-			'''Translate incoming database node id to taxonomydb node id'''
-			inc_taxid = self.dbmod_annotation[self.mod_genomes[genome]].strip()
-			try:
-				id,genomeid = self.nodeDict[inc_taxid],genome.strip()
-			except KeyError:  ## taxid does not exist in receiving database, skip genome
-				#logger.debug("Genome not added {genome}".format(genome=genome))
-				notadded +=1
-				continue
-			if len(self.mod_genomes) < 100:
-				update["set_value"] = id
-				update["where"] = genomeid
-				res = self.taxonomydb.update_genome(update)
-				if self.taxonomydb.rowcount()!=0:
-					if res:
-						updated += 1
-					else:
-						added += 1
-			else:
-				allupdates.append("({id},'{genomeid}')".format(id=id,genomeid=genomeid))
-		if len(self.mod_genomes) >= 100:
-			update["set_value"] = "id"
-			update["where_value"] = "genome"
-			update["data"] = allupdates
-			self.taxonomydb.multi_update(update,"genomes")
-			logger.info("Genomes transfered to increase speed no statistics were calculated")
-		else:
-			if notadded > 0:
-				logger.info("{notadded} genomes not added, taxonomy id does not exist in the receiving database".format(notadded=notadded))
-			logger.info("{added} added and {updated} genome annotations were updated!".format(added=added, updated=updated))
+		added,updated = self.taxonomydb.multi_update(update,"genomes")  ## One transaction per batch
+		if self.notadded > 0:
+			logger.info("{notadded} genomes not added, taxonomy id does not exist in the receiving database".format(notadded=self.notadded))
+		logger.info("{added} added and {updated} genome annotations were updated!".format(added=added, updated=updated))
+		if updated > 0:
+			logger.warning("{updated} genomes already in the database were moved to the node given by the source database".format(updated=updated))
 		self.taxonomydb.commit()
 		return
 
@@ -454,15 +436,19 @@ class ModifyTree(object):
 		self.all_nodes = set(self.taxonomydb.get_nodes(col=1).keys())
 		'''Add parents to all nodes that may not have annotations'''
 		logger.info("Retrieve all parents of annotated nodes")
-		self.annotated_nodes |= self.taxonomydb.get_parents(self.annotated_nodes,find_all=True,ncbi=ncbi)
+		index = self.taxonomydb.tree_index()
+		parents = index.walk([node for node in self.annotated_nodes if index.linked(node)],up=True)
+		if len(parents.cycles) > 0:
+			logger.warning("Found {n} cycles in the lineages of annotated nodes".format(n=len(parents.cycles)))
+		self.annotated_nodes |= parents.nodes()
 		logger.info("Parents added: {an}".format(an=len(self.annotated_nodes)-an))
 		if ncbi:
 			logger.info("Keep main nodes of the NCBI taxonomy (parents on level 3 and above)")
-			self.keep = set(self.taxonomydb.get_children([1],maxdepth=3))  #set([self.nodeDict[node] for node in self.taxonomydb.get_children([1],maxdepth=1)])
+			self.keep = index.walk([1],maxdepth=3).nodes()
 			logger.info("Adding root levels {nlev}".format(nlev=len(self.keep-self.annotated_nodes)))
 			self.annotated_nodes |= self.keep
 		'''Get all links related to an annotated node and its parents'''
-		self.annotated_links = set(self.taxonomydb.get_links(self.annotated_nodes,only_parents=True))
+		self.annotated_links = set(link for link in self.all_links if link[1] in self.annotated_nodes)
 		self.clean_links = self.all_links - self.annotated_links
 		self.clean_nodes = self.all_nodes - self.annotated_nodes
 		logger.info("Links to remove {nlinks}".format(nlinks=len(self.clean_links)))
@@ -522,8 +508,9 @@ class ModifyTree(object):
 			#/
 			# Get parents for leaf-nodes (to-keep and to-delete). Determine which parents are delete-only
 			## NOTE: for some reason the input child is also returned here. Its not intuitive, but it does not matter.
-			parents_keep = set(self.taxonomydb.get_parents(nodes_keep,find_all=True))#,only_parents=True))
-			parents_delete = set(self.taxonomydb.get_parents(nodes_delete,find_all=True))#,only_parents=True))
+			index = self.taxonomydb.tree_index()
+			parents_keep = index.walk([node for node in nodes_keep if index.linked(node)],up=True).nodes()
+			parents_delete = index.walk([node for node in nodes_delete if index.linked(node)],up=True).nodes()
 			parents_deleteOnly = parents_delete.difference(parents_keep)
 			#/
 			# Perform node deletion (leaf-nodes and exclusive parent-nodes)
@@ -563,7 +550,7 @@ class ModifyTree(object):
 		'''Update the database file'''
 		if self.replace:
 			logger.info("Clean up genomes annotated to child nodes from  {parent}".format(parent=self.parent))
-			nodes = self.taxonomydb.get_children(set([self.taxonomydb.get_id(self.parent)])) | set([self.taxonomydb.get_id(self.parent)] )
+			nodes = set(self.taxonomydb.iter_subtree([self.taxonomydb.get_id(self.parent)])) | set([self.taxonomydb.get_id(self.parent)] )
 			logger.debug(nodes)
 			self.taxonomydb.delete_genomes(nodes)
 			self.taxonomydb.query("vacuum") ## Actually remove the data from database
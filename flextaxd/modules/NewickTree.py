@@ -260,7 +260,7 @@ class NewickTree(object):
 		selected = False
 		if taxid:
 			if maxdepth == 0:
-				maxdepth = 1000  ## It is not reasonable to expect trees with more than 1000 levels, if so bug has to be raised
+				maxdepth = None  ## Visualise all levels below the selected node
 			'''Check if double parent'''
 			links = self.database.get_links([taxid],order=True)
 			nodes = self.database.get_node(self.taxonomy[taxid])
@@ -269,7 +269,7 @@ class NewickTree(object):
 				links = self.database.get_links(nodes,order=True)
 			if len(links) > 1:
 				selected,find_tax = self.double_opts_vis(links,taxid)
-			nodes = self.database.get_children(find_tax,maxdepth=maxdepth,selected=selected)
+			nodes = set(self.database.iter_subtree(find_tax,maxdepth=maxdepth,selected=selected))
 			if len(nodes) == 0:
 				raise VisualisationError("Given node has no children")
 			links = self.database.get_links(nodes,order=True)
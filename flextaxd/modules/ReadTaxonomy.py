@@ -8,6 +8,7 @@ from .database.DatabaseConnection import DatabaseFunctions
 import logging
 import gzip
 import sys
+import time
 logger = logging.getLogger(__name__)
 
 class InputError(Exception):
@@ -18,13 +19,15 @@ class InputError(Exception):
 
 class ReadTaxonomy(object):
 	"""docstring for ReadTaxonomy."""
-	def __init__(self, taxonomy_file=False, taxonomy_name=False, database=False,verbose=False,**kwargs):
+	def __init__(self, taxonomy_file=False, taxonomy_name=False, database=False,verbose=False,fast_import=False,staging=False,**kwargs):
 		super(ReadTaxonomy, self).__init__()
-		### Connect to or create database
+		### Connect to or create database (staging builds the database in memory and writes it to disk on persist)
 		if database:
-			self.database = DatabaseFunctions(database,verbose=verbose)
+			self.database = DatabaseFunctions(database,verbose=verbose,staging=staging)
 		else:
 			raise InputError("No database was provided to ReadTaxonomy, abort!")
+		if fast_import:
+			self.database.set_fast_import(True)
 		self.taxonomy_file = taxonomy_file
 		self.verbose = verbose
 		self.taxonomy = {}
@@ -34,6 +37,10 @@ class ReadTaxonomy(object):
 		self.length = 0
 		self.ids = 0
 		self.qiime = 0
+		self.links = []  ## Links waiting to be written by flush_links
+		self.nodes = []  ## Nodes waiting to be written by flush_nodes
+		self.next_id = False
+		self.batch_size = 100000  ## Buffered nodes and links are written when a buffer reaches this size
 
 		## Add base node
 		self.root = self.add_node("root")
@@ -88,6 +95,62 @@ class ReadTaxonomy(object):
 		self.database.add_link(child=child,parent=parent,rank=self.rank[rank])
 		self.ids+=1
 
+	def buffer_link(self, child=None, parent=None,rank="no rank"):
+		'''Add relationship in tree, the link is kept in memory until flush_links is called'''
+		if not child and parent:
+			raise InputError("A link requires both a child and a parent!")
+		self.links.append((parent,child,self.rank[rank]))
+		self.ids+=1
+		if len(self.links) >= self.batch_size:
+			self.flush_links()
+
+	def flush_links(self):
+		'''Write buffered links to the database (in the order they were added)'''
+		self.database.load_links(self.links,hold=True)
+		self.links = []
+
+	def buffer_node(self, description,id=False):
+		'''Add node to tree, unless given the id is assigned locally (next id in the nodes table) and the node
+			is kept in memory until flush_nodes is called, do not mix with add_node before flushing
+		'''
+		if description.strip() == "":  ## do not add empty nodes
+			self.taxonomy[description] = False
+			return False
+		if not self.next_id:
+			self.next_id = self.database.get_taxid_base()
+		if id:
+			self.taxid_base = int(id)
+			self.next_id = max(self.next_id,self.taxid_base+1)
+		else:
+			self.taxid_base = self.next_id
+			self.next_id += 1
+		self.nodes.append((self.taxid_base,description))
+		self.taxonomy[description] = self.taxid_base
+		if len(self.nodes) >= self.batch_size:
+			self.flush_nodes()
+		return self.taxid_base
+
+	def flush_nodes(self):
+		'''Write buffered nodes to the database'''
+		self.database.add_nodes(self.nodes,hold=True)
+		self.nodes = []
+		self.next_id = False
+
+	def write_records(self, records):
+		'''Batched writer shared by the tree readers, records is a generator of (name, id, parent, rank)
+			the node is added (id False assigns the next id) together with the link to its parent, the
+			generator may look up the id of a yielded node in self.taxonomy when it is resumed
+		'''
+		for name,id,parent_i,rank in records:
+			child_i = self.buffer_node(name,id=id)
+			if child_i:
+				self.buffer_link(child_i,parent_i,rank=rank)
+			else:
+				logger.debug("Empty node name, link to {parent} skipped".format(parent=parent_i))
+		self.flush_nodes()
+		self.flush_links()
+		self.database.commit()
+
 	def add_node(self, description,id=False):
 		'''Add node to tree
 			extend databaseFunction add_node function using self.taxonomy
@@ -99,27 +162,42 @@ class ReadTaxonomy(object):
 		return self.taxid_base
 
 
-	def read_nodes(self, treefile=False):
-		'''Read a tab separated node file and store a dictionary with names in object'''
+	def report_rate(self, what, rows, start):
+		'''Log the number of rows loaded and the throughput'''
+		seconds = max(time.time() - start, 1e-6)
+		logger.info("{rows} {what} loaded in {seconds:.1f} seconds ({rate:.0f} rows/s)".format(rows=rows,what=what,seconds=seconds,rate=rows/seconds))
+
+	def read_nodes(self, treefile=False, progress=False):
+		'''Read a tab separated node file and store a dictionary with names in object
+			nodes and links are written in transactions of self.batch_size rows, after each transaction
+			progress(rows, start) is called (default report_rate)
+		'''
 		logger.info("Read nodes in taxonomy file {}".format(treefile))
 		swap = False
 		rank = "no rank"  #Base rank if rank is not used
 		if not treefile:
 			treefile = self.taxonomy_file
+		if not progress:
+			progress = lambda rows,start: self.report_rate("tree rows",rows,start)
+		debug = logger.isEnabledFor(logging.DEBUG)  ## Check log level once, not for every row
+		taxonomy = self.taxonomy
+		sep = self.sep
+		start = time.time()
 		with self.zopen(treefile, "r") as _treefile:
-			headers = _treefile.readline().strip().split(self.sep)
+			headers = _treefile.readline().strip().split(sep)
 			if "parent" not in headers or "child" not in headers:
-				logger.debug("Headers:  {h} separator [{sep}]".format(h=headers,sep=self.sep))
+				logger.debug("Headers:  {h} separator [{sep}]".format(h=headers,sep=sep))
 				raise InputError("Your input tree file does not contain the headers to specify child and parent!")
 			if headers[0] == "parent":
 				swap = True
 			logger.debug("Swap: {swap}".format(swap=swap))
 			for tree_row in _treefile:
-				data = tree_row.strip().split(self.sep)
-				logger.debug(data)
+				data = tree_row.strip().split(sep)
+				if debug:
+					logger.debug(data)
 				if len(data) > 2:
 					rank = data.pop().strip()
-					if rank.strip() != "":
+					if rank != "":
 						self.add_rank(rank)
 				if swap:
 					data[0],data[1] = data[1],data[0]
@@ -128,37 +206,54 @@ class ReadTaxonomy(object):
 					'''Check for empty rows'''
 					continue
 				for node in data:
-					logger.debug(node)
 					node = node.strip()
-					try:
-						self.taxonomy[node]
-					except KeyError:
-						logger.debug("Add node: {node}".format(node=node))
-						self.taxonomy[node] = self.add_node(node)
+					if node not in taxonomy:
+						if debug:
+							logger.debug("Add node: {node}".format(node=node))
+						self.buffer_node(node)
 						self.ids +=1
-				#logger.debug("Add link: {parent}-{child}".format(parent=data[1].strip(),child=data[0].strip()))
-				self.add_link(child=self.taxonomy[data[0].strip()],parent=self.taxonomy[data[1].strip()],rank=rank)
+				self.buffer_link(child=taxonomy[data[0].strip()],parent=taxonomy[data[1].strip()],rank=rank)
 				self.length +=1
+				if self.length % self.batch_size == 0:
+					self.flush_nodes()
+					self.flush_links()
+					self.database.commit()
+					progress(self.length,start)
+			self.flush_nodes()
+			self.flush_links()
 			self.database.commit()
+			if self.length % self.batch_size:
+				progress(self.length,start)
 
-	def parse_genomeid2taxid(self,genomeid2taxid,reference=False):
-		'''Parse file that annotates genome_id´s to nodes in the tree'''
-		nodeDict = self.database.get_nodes()
+	def read_genomeid2taxid(self,genomeid2taxid,nodeDict,reference=False):
+		'''Read a file that annotates genome_id´s to nodes in the tree
+
+		------
+		Returns
+			iterator - (genome, id, reference) rows
+		'''
 		_ref = reference
 		with self.zopen(genomeid2taxid,"rt") as f:
 			# headers = f.readline().strip().split("\t") # This line was commented away since this genomeid2taxid is not documented to have a header
 			for row in f:
-				if row.strip() != "": ## If there are trailing empty lines in the file
+				row = row.strip()
+				if row != "": ## If there are trailing empty lines in the file
 					try:
-						genomeid,taxid = row.strip().split("\t")
+						genomeid,taxid = row.split("\t")
 					except:
 						if not _ref: ## override if there is a reference in file, and use given ref
-							genomeid,taxid,reference = row.strip().split("\t")
+							genomeid,taxid,reference = row.split("\t")
 						else:
-							genomeid,taxid,override = row.strip().split("\t")
+							genomeid,taxid,override = row.split("\t")
 					try:
-						self.database.add_genome(genome=genomeid.strip(),_id=nodeDict[taxid.strip()],reference=reference)
+						yield genomeid.strip(),nodeDict[taxid.strip()],reference
 					except KeyError:
 						logger.warning("# WARNING: {taxid} not found in the database".format(taxid=taxid))
-			self.database.commit()
+
+	def parse_genomeid2taxid(self,genomeid2taxid,reference=False):
+		'''Parse file that annotates genome_id´s to nodes in the tree, annotations are inserted in batches'''
+		nodeDict = self.database.get_nodes()
+		added = self.database.add_genomes(self.read_genomeid2taxid(genomeid2taxid,nodeDict,reference),hold=True)
+		self.database.commit()
+		logger.info("Genomes added to database: {genomes}".format(genomes=added))
 		return
@@ -70,7 +70,7 @@ class ReadTaxonomyCanSNPer(ReadTaxonomy):
 		return root
 
 	def add_SNP(self,nodes,i):
-		'''Add name of node to database'''
+		'''Add name of node to database (yields node records, see ReadTaxonomy.write_records)'''
 		name = nodes[i].strip()
 		logger.debug("Parent did not exit Add parent: {name}".format(name=name))
 
@@ -81,16 +81,15 @@ class ReadTaxonomyCanSNPer(ReadTaxonomy):
 			if i < -len(nodes):
 				return self.root                ## The root has been reached return index of root
 			else:                                ## Parent didn't exist again, add parent to this node and then add the link to that parent
-				parent_i = self.add_SNP(nodes,i-1)## Add node of parent
-		node_i = self.add_node(name)  ## Add node
+				parent_i = yield from self.add_SNP(nodes,i-1)## Add node of parent
+		yield name,False,parent_i,"no rank"     ## Add node and link to next parent
+		node_i = self.taxonomy[name]
 		if node_i:
 			self.taxid_num += 1
-		self.add_link(node_i, parent_i)            ## Add link to next parent
 		return node_i     ##  index of child
 
-	def parse_taxonomy(self):
-		'''Retrieve node description from CanSNPer formatted tree'''
-		logger.info("Parse CanSNP tree file")
+	def iter_records(self):
+		'''Read the CanSNPer formatted tree and yield node records'''
 		with self.zopen(self.taxonomy_file,"r") as f:
 			for row in f:
 				row = row.strip().replace("\t",";")  ## Also accept tab separated tree files
@@ -102,14 +101,17 @@ class ReadTaxonomyCanSNPer(ReadTaxonomy):
 					pname = nodes[-2].strip()
 					parent_i = self.taxonomy[pname]  ## Check if parent of child node exists
 				except KeyError: ## parent node does not exist, add parent
-					parent_i = self.add_SNP(nodes,-2)
+					parent_i = yield from self.add_SNP(nodes,-2)
 				except IndexError: ## Should be first row with only one node (parent)
 					self.taxonomy[child] = self.root
 					parent_i = self.root
 					continue
 				'''Now all parents exists, add new child node and add the link'''
-				child_i = self.add_node(child)
-				self.database.add_link(child_i,parent_i)
-		self.database.commit()
+				yield child,False,parent_i,"no rank"
+
+	def parse_taxonomy(self):
+		'''Retrieve node description from CanSNPer formatted tree'''
+		logger.info("Parse CanSNP tree file")
+		self.write_records(self.iter_records())
 		self.length = self.taxid_num - self.root                ## Check number of new nodes added
 		logger.info("New taxonomy ids assigned {taxidnr}".format(taxidnr=self.length))
@@ -5,16 +5,25 @@ Read NCBI taxonomy dmp files (nodes or names) and holds a dictionary
 '''
 
 from .ReadTaxonomy import ReadTaxonomy
-from gzip import open as zopen
+from .functions import open_gzip
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 import zlib
 import os
+import time
 import logging
 logger = logging.getLogger(__name__)
 
+try:
+	from gzip import BadGzipFile
+except ImportError:  ## BadGzipFile was added in python 3.8, older versions raise OSError
+	class BadGzipFile(OSError):
+	    """Exception raised in some cases for invalid gzip files."""
+
 class ReadTaxonomyNCBI(ReadTaxonomy):
 	"""docstring for ReadTaxonomyNCBI."""
 	def __init__(self, taxonomy_file=False, database=False,**kwargs):
-		super(ReadTaxonomyNCBI, self).__init__(database=database)
+		super(ReadTaxonomyNCBI, self).__init__(database=database,**kwargs)
 		self.taxonomy_file = taxonomy_file
 		self.names_dmp = taxonomy_file.replace("nodes","names")
 		self.names = {}
@@ -43,88 +52,206 @@ class ReadTaxonomyNCBI(ReadTaxonomy):
 			self.read_nodes(self.taxonomy_file)
 			self.ids = self.database.num_rows("tree")
 
+	def read_blocks(self, taxfile, block_size=1<<24):
+		'''Read a dmp file in large binary blocks
+
+		------
+		Returns
+			iterator - list of complete lines (bytes) per block
+		'''
+		with open(taxfile, "rb") as _taxfile:
+			rest = b""
+			for block in iter(lambda: _taxfile.read(block_size), b""):
+				lines = (rest + block).split(b"\n")
+				rest = lines.pop()
+				yield lines
+			if rest:
+				yield [rest]
+
 	def read_nodes(self, taxfile):
-		'''Read NCBI node file and store a dictionary with names in object'''
-		with open(taxfile, "r") as _taxfile:
-			for taxonomy_row in _taxfile:
-				data = taxonomy_row.strip().split("\t|\t")
-				child,parent,rank = data[0],data[1],data[2]
-				if rank == "None" or rank == None:
-					rank = "no rank"
-				if rank not in self.rank:
-					self.add_rank(rank)
-				lev = self.rank[rank]
-				self.database.add_link(child=data[0],parent=data[1],rank=lev)
-			self.database.commit()
+		'''Read NCBI node file into columnar arrays and bulk load the tree'''
+		start = time.time()
+		child = array("l")
+		parent = array("l")
+		rank_names = []
+		for lines in self.read_blocks(taxfile):
+			for line in lines:
+				data = line.split(b"\t|\t",3)
+				if len(data) < 3:
+					continue
+				child.append(int(data[0]))
+				parent.append(int(data[1]))
+				rank_names.append(data[2])
+		## Add each rank once (in order of appearance) and translate the rank column to rank ids
+		ranks = {}
+		for rank in dict.fromkeys(rank_names):
+			name = rank.decode("utf-8").strip()
+			if name == "None" or name == "":
+				name = "no rank"
+			if name not in self.rank:
+				self.add_rank(name)
+			ranks[rank] = self.rank[name]
+		rank_i = array("l", (ranks[rank] for rank in rank_names))
+		del rank_names
+		added = self.database.load_links(zip(parent,child,rank_i),hold=True)
+		self.database.commit()
+		self.report_rate("links",added,start)
 		return
 
 	def read_names(self, taxfile):
-		'''Read NCBI node file and store a dictionary with nodes in object'''
-		with open(taxfile, "r") as _taxfile:
-			for taxonomy_row in _taxfile:
-				data = taxonomy_row.strip().split("\t|\t")
-				taxid = data[0]
-				name = data[1]
-				_type = False
-				if len(data) > 3:
-					_type = data[3].rstrip("|\t")
-				if _type == "scientific name" or not _type:
-					self.add_node(name, id=taxid)
-			self.database.commit()
+		'''Read NCBI names file into columnar arrays (scientific names only) and bulk load the nodes'''
+		start = time.time()
+		ids = array("l")
+		names = []
+		for lines in self.read_blocks(taxfile):
+			for line in lines:
+				data = line.split(b"\t|\t")
+				if len(data) < 2:
+					continue
+				if len(data) > 3 and data[3].rstrip(b"|\t\r") != b"scientific name":
+					continue
+				ids.append(int(data[0]))
+				names.append(data[1].decode("utf-8"))
+		added = self.database.add_nodes(zip(ids,names),hold=True)
+		self.database.commit()
+		self.report_rate("names",added,start)
 		return
 
-	def parse_genebank_file(self,filepath,filename):
+	def parse_genebank_file(self,filepath,filename,block_size=1<<16):
+		'''Read the first sequence header of a (gzipped) fasta file, only the first block(s) of the file
+			are read and decompressed
+
+		------
+		Returns
+			tuple - (refseqid, genebankid)
+		'''
 		logger.debug("Parse file {filename}".format(filename=filename))
-		print("{filename}".format(filename=filename))
 		genebankid = filename.split("_",2)
 		genebankid = genebankid[0]+"_"+genebankid[1]
-		f = zopen(filepath,"r")
-		refseqid = f.readline().split(b" ")[0].lstrip(b">")
-		f.close()
-		self.refseqid_to_GCF[refseqid] = genebankid
+		header = b""
+		with open(filepath,"rb") as f:
+			block = f.read(block_size)
+			if block[:2] == b"\x1f\x8b":  ## gzip magic number
+				decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+				while block and b"\n" not in header:
+					header += decompressor.decompress(block)
+					block = f.read(block_size)
+			else:
+				while block and b"\n" not in header:
+					header += block
+					block = f.read(block_size)
+		header = header.split(b"\n",1)[0].split()
+		if not header:
+			logger.warning("No sequence header found in {filename}".format(filename=filename))
+			return b"",genebankid
+		return header[0].lstrip(b">"),genebankid
+
+	def read_header_cache(self,cache_file):
+		'''Read cached headers, the cache is keyed by file path, size and mtime
+
+		------
+		Returns
+			dict - (path,size,mtime) -> (refseqid,genebankid)
+		'''
+		cache = {}
+		try:
+			with open(cache_file,"rb") as f:
+				for row in f:
+					filepath,size,mtime,refseqid,genebankid = row.rstrip(b"\n").split(b"\t")
+					cache[(filepath.decode("utf-8"),int(size),int(mtime))] = (refseqid,genebankid.decode("utf-8"))
+		except (OSError,ValueError) as e:
+			logger.debug("Could not read header cache {file}: {e}".format(file=cache_file,e=e))
+		return cache
+
+	def write_header_cache(self,cache_file,cache):
+		'''Write the header cache, if the cache cannot be written the scan continues without a cache'''
+		try:
+			with open(cache_file+".tmp","wb") as of:
+				for (filepath,size,mtime),(refseqid,genebankid) in cache.items():
+					of.write(b"\t".join([filepath.encode("utf-8"),str(size).encode(),str(mtime).encode(),refseqid,genebankid.encode("utf-8")])+b"\n")
+			os.replace(cache_file+".tmp",cache_file)
+		except OSError as e:
+			logger.info("Could not write header cache {file}, no cache is kept: {e}".format(file=cache_file,e=e))
+			try:
+				os.remove(cache_file+".tmp")
+			except OSError:
+				pass
 		return
 
-	def parse_genomeid2taxid(self, genomes_path,annotation_file,reference="refseq"):
+	def scan_genomes_folder(self,genomes_path,threads=None,use_cache=True,cache_file=None):
+		'''Read the first header of all sequence files in genomes_path in parallel, the headers are
+			cached next to the database (or in cache_file) so the genomes folder is only read from
+
+		------
+		Returns
+			dict - refseqid -> genebankid (GCF)
+		'''
+		if cache_file is None:
+			cache_file = os.path.abspath(self.database.database)+".header_cache.tsv"
+		cache = self.read_header_cache(cache_file) if use_cache else {}
+		files = {}
+		for root, dirs, filenames in os.walk(genomes_path,followlinks=True):
+			for filename in filenames:
+				if filename.strip(".gz").endswith(".fna"):
+					filepath = os.path.join(root, filename)
+					stat = os.stat(filepath)
+					files[(filepath,stat.st_size,stat.st_mtime_ns)] = filename
+		headers = {key:cache[key] for key in files if key in cache}
+		new = [key for key in files if key not in headers]
+		logger.info("{n} sequence files found, {c} headers cached".format(n=len(files),c=len(headers)))
+		if new:
+			with ThreadPoolExecutor(max_workers=threads) as executor:
+				for key,header in zip(new,executor.map(lambda key: self.parse_genebank_file(key[0],files[key]),new)):
+					headers[key] = header
+			if use_cache:
+				self.write_header_cache(cache_file,headers)
+		return {refseqid:genebankid for refseqid,genebankid in headers.values() if refseqid}
+
+	def join_accession2taxid(self, annotation_file, wanted, annotated, reference, block_size=1<<26):
+		'''Stream the accession2taxid file in large binary blocks and yield only rows with an
+			accession.version found in wanted (accession -> genome id)
+
+		------
+		Returns
+			iterator - (genome,taxid,reference) rows, the matched accessions are added to annotated
+		'''
+		with open_gzip(annotation_file) as f:
+			header = f.readline()
+			if not header.startswith(b"accession"): ## No header, keep the first row
+				rest = header
+			else:
+				rest = b""
+			for block in iter(lambda: f.read(block_size), b""):
+				lines = (rest + block).split(b"\n")
+				rest = lines.pop()
+				for row in lines:
+					data = row.split(b"\t",3)
+					if len(data) > 2 and data[1] in wanted:
+						annotated.add(data[1])
+						yield wanted[data[1]],int(data[2]),reference
+			data = rest.split(b"\t",3)
+			if len(data) > 2 and data[1] in wanted:
+				annotated.add(data[1])
+				yield wanted[data[1]],int(data[2]),reference
+
+	def parse_genomeid2taxid(self, genomes_path,annotation_file,reference="refseq",threads=None,cache_file=None):
 		'''To allow NCBI databases to be build from scratch the sequences names needs to be stored in the database,
 			this function parses the accession2taxid file from NCBI to speed up the function and reduce the amount
 			of stored datata only sequences in input genomes_path will be fetched
 		'''
 		logger.info("Parsing ncbi accession2taxid, genome_path: {dir}".format(dir = genomes_path))
-		self.refseqid_to_GCF = {}
-		for root, dirs, files in os.walk(genomes_path,followlinks=True):
-			for filename in files:
-				print(filename)
-				if filename.strip(".gz").endswith(".fna"):
-					filepath = os.path.join(root, filename)
-					self.parse_genebank_file(filepath,filename)
+		self.refseqid_to_GCF = self.scan_genomes_folder(genomes_path,threads=threads,cache_file=cache_file)
 		logger.info("genomes folder read, {n} sequence files found".format(n=len(self.refseqid_to_GCF)))
 		if not annotation_file.endswith("accession2taxid.gz"):
 			raise TypeError("The supplied annotation file does not seem to be the ncbi nucl_gb.accession2taxid.gz")
 		annotated_genome = set()
+		genomes = []
 		try:
-			with zopen(annotation_file,"r") as f:
-				headers = f.readline().split(b"\t")
-				for row in f:
-					if row.strip() != "": ## If there are trailing empty lines in the file
-						if len(row.split(b"\t")) > 2:
-							try:
-								refseqid,taxid = row.split(b"\t")[1:3]
-							except:
-								logger.info(row)
-								logger.info(row.split(b"\t"))
-								if len(annotated_genome) > 0:
-									logger.info("Potential error in last row?")
-								else:
-									logger.info("Error on first line in annotation file, check format!")
-							try:
-								genebankid = self.refseqid_to_GCF[refseqid]
-								self.database.add_genome(genome=genebankid,_id=taxid.decode("utf-8"),reference=reference)
-								annotated_genome.add(refseqid)
-							except KeyError:
-								pass
-				self.database.commit()
-		except zlib.error as e:
+			genomes.extend(self.join_accession2taxid(annotation_file,self.refseqid_to_GCF,annotated_genome,reference))
+		except (zlib.error,EOFError,BadGzipFile) as e:
 			logger.info("Error in annotation file {e}".format(e=e))
+		annotated = self.database.add_genomes(genomes)
+		logger.info("{n} genomes annotated".format(n=annotated))
 		missing = set(self.refseqid_to_GCF.keys()) - annotated_genome
 		missing = [self.refseqid_to_GCF[m] for m in missing] ## Translate to GCF ids
 		if logging.root.level <=20: ## Equal to --verbose
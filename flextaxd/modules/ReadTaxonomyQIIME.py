@@ -6,18 +6,64 @@ Read QIIME formatted taxonomy files and holds a dictionary with taxonomy tree an
 
 from .ReadTaxonomy import ReadTaxonomy
 from .database.DatabaseConnection import DatabaseFunctions
+from multiprocessing import Pool
+import os
 import logging
 logger = logging.getLogger(__name__)
 
+refDict = {"RS":"refseq","GB":"genbank"}  ## Refdict for GTDB formatted sources
+
+def parse_chunk(chunk):
+	'''Parse a byte range (aligned to line breaks) of a QIIME formatted file, runs in worker processes
+
+	Parameters
+		tuple - (path, start, end, _ref) _ref is True if the reference prefix (RS/GB) should be kept as is
+	------
+	Returns
+		list - unique lineage strings in order of first appearance
+		list - (genome_id, reference, lineage index) per row, None if not given on the row
+		int  - number of rows that could not be parsed
+	'''
+	path,start,end,_ref = chunk
+	with open(path,"rb") as f:
+		f.seek(start)
+		rows = f.read(end-start).decode("utf-8").split("\n")
+	lineages = {}
+	records = []
+	errors = 0
+	for row in rows:
+		row = row.strip()
+		if row != "":  ## If there are trailing empty lines in the file
+			data = row.split("\t")
+			genome_id = reference = None
+			try:
+				if data[0].startswith(("RS","GB")):
+					'''GTDB genome annotations contain one additional annotation to their genome names eg. RS_, this function removes this'''
+					reference,genome_id = data[0].split("_",1)   ## Genome ID
+					genome_id = genome_id.strip()
+					if not _ref:
+						reference = refDict[reference]
+				else:
+					genome_id = data[0].strip()
+					'''Greengenes adaption, empty levels'''
+			except IndexError:
+				logger.debug("Row {row} could not be parsed".format(row=data))
+				errors +=1
+			lineage_i = lineages.setdefault(data[-1],len(lineages))
+			records.append((genome_id,reference,lineage_i))
+	return list(lineages),records,errors
+
 class ReadTaxonomyQIIME(ReadTaxonomy):
 	"""docstring for ReadTaxonomyQIIME."""
-	def __init__(self, taxonomy_file=False, names_dmp=False, database=False, verbose=False, taxid_base=1,**kwargs):
+	def __init__(self, taxonomy_file=False, names_dmp=False, database=False, verbose=False, taxid_base=1,processes=1,**kwargs):
 		super(ReadTaxonomyQIIME, self).__init__(taxonomy_file=taxonomy_file, database=database,verbose=verbose,**kwargs)
 		#self.database = DatabaseFunctions(database,verbose=verbose)  # Not nessesary opens in parent class
 		self.input = taxonomy_file
 		self.names = {}
 		self.taxid_base = taxid_base
 		self.taxonomy = {}
+		self.lineages = {}  ## Lineage string (d__;p__;...) -> node id of its last level
+		self.processes = processes
 		self.length = 0
 		self.ids = 0
 		self.levelDict = {
@@ -61,7 +107,20 @@ class ReadTaxonomyQIIME(ReadTaxonomy):
 		self.qiime_to_tree()
 
 	def parse_tree(self,tree,current_i=0):
-		'''The taxonomy tree does not exist in the standard nomenclature, add a new tree'''
+		'''The taxonomy tree does not exist in the standard nomenclature, add a new tree
+			each lineage (and parent lineage) is resolved once and then cached in self.lineages
+		'''
+		lineage = ";".join(reversed(tree[current_i:]))
+		try:
+			return self.lineages[lineage]
+		except KeyError:
+			pass
+		node_i = self.resolve_lineage(tree,current_i)
+		self.lineages[lineage] = node_i
+		return node_i
+
+	def resolve_lineage(self,tree,current_i=0):
+		'''Add the nodes and links of a lineage not seen before'''
 		### Add parent description if not exist
 		level,description = self.parse_description(tree,current_i)
 		if description.strip() == "":
@@ -73,7 +132,7 @@ class ReadTaxonomyQIIME(ReadTaxonomy):
 			try:
 				return self.taxonomy[description]
 			except KeyError:
-				node_i = self.add_node(description)
+				node_i = self.buffer_node(description)
 			return node_i
 		parent_i = self.parse_tree(tree,current_i+1)
 		try:
@@ -81,10 +140,10 @@ class ReadTaxonomyQIIME(ReadTaxonomy):
 			return self.taxonomy[description]
 		except KeyError:
 			''' Add current node to names file '''
-			node_i = self.add_node(description)
+			node_i = self.buffer_node(description)
 
 		'''When all parents exist add current relation to tree file'''
-		self.add_link(node_i,parent_i,rank=level)
+		self.buffer_link(node_i,parent_i,rank=level)
 		'''return new tax_i'''
 		return node_i
 
@@ -98,47 +157,89 @@ class ReadTaxonomyQIIME(ReadTaxonomy):
 		return level,description
 
 
+	def flush_genomes(self):
+		'''Write buffered genome annotations to the database, the buffered nodes and links are written
+			first and the batch is committed as one transaction'''
+		self.flush_nodes()
+		self.flush_links()
+		self.added += self.database.add_genomes(self.genomes,hold=True)
+		self.database.commit()
+		self.genomes = []
+
+	def chunk_file(self, chunk_size=1<<24):
+		'''Split the input file into byte ranges starting and ending at line breaks
+
+		------
+		Returns
+			list - (start,end) byte offsets
+		'''
+		size = os.path.getsize(self.input)
+		bounds = [0]
+		with open(self.input,"rb") as f:
+			while bounds[-1] < size:
+				f.seek(min(bounds[-1]+chunk_size,size))
+				f.readline()
+				bounds.append(min(f.tell(),size))
+		return list(zip(bounds[:-1],bounds[1:]))
+
 	def qiime_to_tree(self, sep="\t",reference=False):
-		'''Read the qiime format file and parse out the relation tree (nodes.dmp)'''
+		'''Read the qiime format file and parse out the relation tree (nodes.dmp)
+			the file is parsed in chunks (in parallel if processes > 1), node ids are assigned here
+			in file order so the result is identical to a serial run
+		'''
 		self.sep = sep
 		self.tree = set()
 		self.missed = 0
 		self.errors = 0
 		self.added = 0
 		_ref = reference
-		refDict = {"RS":"refseq","GB":"genbank"}  ## Refdict for GTDB formatted sources
 		taxid_start = self.taxid_base
-		with open(self.input) as f:
-			'''Each row defines a genome annotation file connected to a tree level'''
-			for row in f:
-				if row.strip() != "":  ## If there are trailing empty lines in the file
-					data = row.strip().split("\t")
+		self.genomes = []
+		lineages = self.lineages
+		genome_id = None
+		chunk_size = 1<<24
+		if self.processes > 1:
+			chunk_size = max(1<<20,min(chunk_size,os.path.getsize(self.input)//(self.processes*4)+1))
+		chunks = [(self.input,start,end,_ref) for start,end in self.chunk_file(chunk_size)]
+		pool = False
+		if self.processes > 1 and len(chunks) > 1:
+			logger.info("Parse {n} chunks using {p} processes".format(n=len(chunks),p=self.processes))
+			pool = Pool(self.processes)
+			results = pool.imap(parse_chunk,chunks)
+		else:
+			results = map(parse_chunk,chunks)
+		try:
+			for chunk_lineages,records,errors in results:
+				self.errors += errors
+				### Walk through tree and make sure all nodes back to root are annotated!
+				taxonomy_ids = []
+				for lineage in chunk_lineages:
 					try:
-						if data[0].startswith(("RS","GB")):
-							'''GTDB genome annotations contain one additional annotation to their genome names eg. RS_, this function removes this'''
-							reference,genome_id = data[0].split("_",1)   ## Genome ID
-							genome_id = genome_id.strip()
-							if not _ref:
-								reference = refDict[reference]
-						else:
-							genome_id = data[0].strip()
-							'''Greengenes adaption, empty levels'''
-
-						#print(genome_id)
-					except IndexError:
-						logger.debug("Row {row} could not be parsed".format(row=data))
-						self.errors +=1
-					### Walk through tree and make sure all nodes back to root are annotated!
-					taxonomy = list(reversed(data[-1].split(";")))
-					taxonomy_i = self.parse_tree(taxonomy)
+						taxonomy_ids.append(lineages[lineage])
+					except KeyError:
+						taxonomy_ids.append(self.parse_tree(list(reversed(lineage.split(";")))))
+				for _genome_id,_reference,lineage_i in records:
+					if _genome_id is not None:
+						genome_id = _genome_id
+					if _reference is not None:
+						reference = _reference
+					taxonomy_i = taxonomy_ids[lineage_i]
 					if taxonomy_i:
-						test = self.database.add_genome(genome=genome_id,_id=taxonomy_i,reference=reference)
-						if not str(test).startswith("UNIQUE"):
-							self.added +=1
+						self.genomes.append((genome_id,taxonomy_i,reference))
+						if len(self.genomes) >= self.batch_size:
+							self.flush_genomes()
 					else:
 						logger.debug("Warning taxonomy: {taxonomy} could not be parsed!!")
 						self.missed +=1
-		self.database.commit()
+		except BaseException:
+			if pool:
+				pool.terminate()  ## Stop the workers without parsing the queued chunks
+				pool.join()
+			raise
+		if pool:
+			pool.close()
+			pool.join()
+		self.flush_genomes()
 		self.length = self.taxid_base - taxid_start
 		logger.info("Genomes added to database: {genomes}".format(genomes=self.added))
 		logger.debug("Genomes not added to database {missed} errors {errors}".format(missed=self.missed,errors=self.errors))
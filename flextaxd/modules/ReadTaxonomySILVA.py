@@ -36,9 +36,8 @@ class ReadTaxonomySILVA(ReadTaxonomy):
 		self.database.commit()
 		logger.debug("Root: {root} link: [{base}]".format(root=self.root, base=self.taxid_num))
 
-	def parse_taxonomy(self):
-		'''Retrieve node description from SILVA formatted tree'''
-		logger.info("Parse SILVA tree file")
+	def iter_records(self):
+		'''Read the SILVA formatted tree and yield node records'''
 		with self.zopen(self.taxonomy_file,"r") as f:
 			for row in f:
 				tree,info = row.strip().rsplit(";",1) ## separate tree from info columns
@@ -55,13 +54,14 @@ class ReadTaxonomySILVA(ReadTaxonomy):
 					pname = nodes[-2].strip()
 					parent_i = self.taxonomy[pname]  ## Check if parent of child node exists
 				except IndexError: ## Should be first row with only one node (parent)
-					child_i = self.add_node(child,id=taxid)
-					self.add_link(child_i,self.root,rank=rank)
-					continue
+					parent_i = self.root
 				'''Now all parents exists, add new child node and add the link'''
-				child_i = self.add_node(child,id=taxid)
-				self.add_link(child_i,parent_i,rank=rank)
-		self.database.commit()
+				yield child,taxid,parent_i,rank
+
+	def parse_taxonomy(self):
+		'''Retrieve node description from SILVA formatted tree'''
+		logger.info("Parse SILVA tree file")
+		self.write_records(self.iter_records())
 		self.length = len(self.taxonomy)                ## Check number of new nodes added
 		self.taxid_num = len(self.taxonomy)
 		logger.info("New taxonomy ids assigned {taxidnr}".format(taxidnr=self.length))
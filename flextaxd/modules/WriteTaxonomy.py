@@ -4,15 +4,27 @@
 Read NCBI taxonomy dmp files (nodes or names) and holds a dictionary
 '''
 
-from .database.DatabaseConnection import DatabaseFunctions
+from .database.DatabaseConnection import DatabaseFunctions, batched
+from .BinaryTaxonomy import write_binary
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import starmap
+from urllib.request import pathname2url
+import sqlite3
+import gzip
+import hashlib
+import io
+import os
 import logging
 logger = logging.getLogger(__name__)
 
 class WriteTaxonomy(object):
 	"""docstring for WriteTaxonomy."""
-	def __init__(self, path, database=".taxonomydb",separator="\t|\t",minimal=False,prefix="names,nodes",desc=False,dbprogram=None,dump_genomes=False):
+	def __init__(self, path, database=".taxonomydb",separator="\t|\t",minimal=False,prefix="names,nodes",desc=False,dbprogram=None,dump_genomes=False,compress=False,track_changes=True):
 		super(WriteTaxonomy, self).__init__()
 		self.database = DatabaseFunctions(database)
+		self.database_file = self.database.database
 		logging.debug("Write settings: ")
 		self.path = path.rstrip("/")+"/"
 		logging.debug("Output path: {outdir}".format(outdir=self.path))
@@ -38,27 +50,61 @@ class WriteTaxonomy(object):
 		if self.dbprogram: logging.debug("Output format for program {program}".format(program=self.dbprogram))
 		self.link_order = False ## Default print is NCBI structure with child in the first column
 		logging.debug("NCBI structure (child first): {parent}".format(parent=self.link_order))
+		self.batch_size = 100000	## Rows fetched from the database per batch
+		self.buffer_size = 4194304	## Output buffer size in bytes
+		self.compress = compress	## gzip the dump files
+		self.track_changes = track_changes	## Log database changes so that unchanged dumps are skipped
+		self.remap = None			## Unique indexes of repeated child links (tree rowid to index), set by prepare
 
-	def dump_genomes(self):
-		'''Write the list of annotated genomes to a file'''
-		with open('{}{}.dmp'.format(self.path,"genomes"),"w") as outputfile:
-			genomes = self.get_all('genomes', 'genome,reference', sort="reference")
-			for genome in genomes:
-				print(*genome, sep="\t", end="\n", file=outputfile)
-		return
-
-	def dump_genome_annotations(self, sort="reference"):
-		'''Dump all genomes, including their taxonomy reference (will work as input file for genomeid2taxid)'''
-		select = "genome,name,reference"
-		QUERY = "SELECT {select} FROM genomes JOIN nodes ON nodes.id=genomes.id".format(select=select)
+	def dump_genomes(self, sort="reference", workers=1):
+		'''Write the list of annotated genomes to a file, see write_genomes'''
+		self.write_genomes("genome,reference", sort=sort, workers=workers)
+
+	def dump_genome_annotations(self, sort="reference", workers=1):
+		'''Dump all genomes, including their taxonomy reference (will work as input file for genomeid2taxid), see write_genomes'''
+		self.write_genomes("genome,name,reference", join=True, sort=sort, workers=workers)
+
+	def write_genomes(self, select, join=False, sort="reference", workers=1):
+		'''Stream genomes from a read-only cursor to genomes.dmp. The descending sort is read from the
+			genomes reference index (ties in table order) and sort=False writes the genomes in table order.
+			When the dump is compressed and workers > 1 chunks of rows are compressed in parallel
+		'''
+		QUERY = "SELECT {select} FROM genomes".format(select=select)
+		if join:
+			QUERY += " JOIN nodes ON nodes.id=genomes.id"
 		if sort:
-			QUERY += " ORDER BY {col} DESC".format(col=sort)
-		logging.debug(QUERY)
-		with open('{}{}.dmp'.format(self.path,"genomes"),"w") as outputfile:
-			genomes = self.database.query(QUERY).fetchall()
-			for genome in genomes:
-				print(*genome, sep="\t", end="\n", file=outputfile)
-		return
+			QUERY += " ORDER BY {col} DESC, genomes.rowid DESC".format(col=sort)
+		logging.info('Write genomes to: {}'.format(self.output_file("genomes")))
+		line = self.line_template(range(len(select.split(","))),separator="\t")
+		conn = self.connect()
+		try:
+			genomes = self.iter_query(QUERY,conn)
+			if self.compress and workers > 1:
+				self.write_chunks(self.output_file("genomes"),genomes,line,workers)
+			else:
+				with self.open_output("genomes") as outputfile:
+					outputfile.writelines(starmap(line,genomes))
+		finally:
+			conn.close()
+
+	def write_chunks(self, filename, rows, line, workers):
+		'''Format rows in chunks of batch_size and gzip compress the chunks in parallel threads (zlib releases the GIL),
+			each chunk is written in order as a gzip member and at most two chunks per worker are held in memory'''
+		pending = deque()
+		with ThreadPoolExecutor(max_workers=workers) as executor, open(filename,"wb") as outputfile:
+			for chunk in batched(rows,self.batch_size):
+				pending.append(executor.submit(self.compress_chunk,"".join(starmap(line,chunk))))
+				if len(pending) >= 2*workers:
+					outputfile.write(pending.popleft().result())
+			while pending:
+				outputfile.write(pending.popleft().result())
+
+	def compress_chunk(self, text):
+		'''Compress text to one gzip member without a timestamp (gzip.compress only takes mtime from python 3.8)'''
+		member = io.BytesIO()
+		with gzip.GzipFile(fileobj=member,mode="wb",compresslevel=6,mtime=0) as outputfile:
+			outputfile.write(text.encode("utf-8"))
+		return member.getvalue()
 
 	def set_separator(self,sep):
 		self.separator=sep
@@ -95,73 +141,275 @@ class WriteTaxonomy(object):
 		logging.debug(QUERY)
 		return self.database.query(QUERY).fetchall()
 
+	def connect(self):
+		'''Open a separate read-only connection to the database, each writer uses its own connection
+			so that nodes and names can be written at the same time'''
+		return sqlite3.connect("file:{path}?mode=ro".format(path=pathname2url(os.path.abspath(self.database_file))),uri=True)
+
+	def __getstate__(self):
+		'''The writer is sent to the nodes process without its database connection (the writers open their own
+			read-only connections), the node names are only sent when nodes are written with descriptions'''
+		state = self.__dict__.copy()
+		state["database"] = None
+		if not self.dump_descriptions:
+			state.pop("nodeDict",None)
+		return state
+
+	def iter_query(self, QUERY, conn=False):
+		'''Stream the rows of a query in fetchmany batches from a separate cursor'''
+		logging.debug(QUERY)
+		cursor = conn.cursor() if conn else self.database.conn.cursor()
+		try:
+			cursor.execute(QUERY)
+			rows = cursor.fetchmany(self.batch_size)
+			while rows:
+				yield from rows
+				rows = cursor.fetchmany(self.batch_size)
+		finally:
+			cursor.close()
+
+	def output_file(self, prefix):
+		'''Get the output file name of a dump (.dmp.gz if compressed)'''
+		filename = '{}{}.dmp'.format(self.path,prefix)
+		if self.compress:
+			filename += ".gz"
+		return filename
+
+	def open_output(self, prefix):
+		'''Open a dump for writing through a large buffer, gzip compressed on the fly if compress is set
+			(the gzip header has no timestamp so identical dumps give identical files)'''
+		filename = self.output_file(prefix)
+		if self.compress:
+			return io.TextIOWrapper(io.BufferedWriter(gzip.GzipFile(filename,"wb",compresslevel=6,mtime=0),self.buffer_size))
+		return open(filename,"w",buffering=self.buffer_size)
+
+	def line_template(self, columns, extra=[], end="\n", separator=None):
+		'''Precompile the output line, columns are the row indexes to print followed by the constant extra columns
+			(separated by the dump separator unless another separator is given)
+
+		------
+		Returns
+			function - format function taking the row values
+		'''
+		escape = lambda text: str(text).replace("{","{{").replace("}","}}")
+		fields = ["{"+str(i)+"}" for i in columns] + [escape(col) for col in extra]
+		return (escape(separator or self.separator).join(fields) + escape(end)).format
+
 	def unique_indexes(self):
 		'''Check duplicated indexes and give them unique IDs before print'''
 		QUERY = "SELECT child FROM tree GROUP BY child HAVING count(parent) > 1"  ## Thanks to andrewjmc@github for this suggestion
-		child_w_dpi = self.database.query(QUERY).fetchall()  ## Fetch all conflicting links and give them unique index before printing
-		child_w_dpi = list(*child_w_dpi)
+		child_w_dpi = set(child for child, in self.database.query(QUERY).fetchall())  ## Fetch all conflicting links and give them unique index before printing
 		lmax = 10000000
 		if len(child_w_dpi) > 0:
 			self.nodeDict = self.database.get_nodes(col=1)
 			lmax = max(self.nodeDict)
 		return lmax,child_w_dpi
 
-	def nodes(self):
-		'''Write database tree to nodes.dmp'''
-		logging.info('Write tree to: {}{}.dmp'.format(self.path,self.prefix[1]))
-		child_w_dpi = []
-		checklist = {}
-		with open('{}{}.dmp'.format(self.path,self.prefix[1]),"w") as outputfile:
-			## Retrieve all links that exists in the database
-			if self.dump_descriptions:
-				self.nodeDict = self.database.get_nodes()
-				print("child\tparent\trank", sep=self.separator, end="\n", file=outputfile)
+	def unique_links(self, child_w_dpi, lmax):
+		'''If child with duplicate index, make sure link has unique index, the first link of a child keeps the node id
+			and the new indexes (counted from lmax+102) are added to nodeDict (written by names)
+
+		------
+		Returns
+			dict - tree rowid to new child index
+		'''
+		QUERY = '''SELECT tree.rowid,child FROM tree JOIN (rank) on rank.rank_i = tree.rank_i
+					WHERE child IN (SELECT child FROM tree GROUP BY child HAVING count(parent) > 1) ORDER BY tree.rowid'''
+		logging.debug(QUERY)
+		remap = {}
+		checklist = set()
+		index = lmax+101
+		for rowid,child in self.database.query(QUERY).fetchall():
+			if child in checklist and child in self.nodeDict:
+				index += 1
+				'''Update node index to uniqe'''
+				remap[rowid] = index
+				self.nodeDict[index] = self.nodeDict[child]
+				self.updated = True
+			else:
+				checklist.add(child)
+		return remap
+
+	def prepare(self):
+		'''Load what nodes and names share once, the node descriptions or the unique index remap'''
+		if self.dump_descriptions:
+			self.nodeDict = self.database.get_nodes()
+			self.remap = {}
+			return
+		lmax,child_w_dpi = self.unique_indexes()
+		self.remap = self.unique_links(child_w_dpi,lmax) if len(child_w_dpi) > 0 else {}
+
+	def settings(self):
+		'''Describe the output format, a dump is only reused if it was written with the same settings'''
+		return repr((self.separator,self.minimal,self.dump_descriptions,self.dbprogram,self.link_order,self.compress))
+
+	def file_md5(self, filename):
+		'''Get the md5 checksum of a file'''
+		md5 = hashlib.md5()
+		with open(filename,"rb") as f:
+			for block in iter(lambda: f.read(self.buffer_size), b""):
+				md5.update(block)
+		return md5.hexdigest()
+
+	def unchanged(self, files, seq):
+		'''Check if the dump files are up to date, they must have been written with the same settings,
+			no change may have been logged since and the files must not have been modified
+
+		------
+		Returns
+			boolean
+		'''
+		for filename in files:
+			state = self.database.get_dump_state(os.path.abspath(filename))
+			if state is None or not os.path.exists(filename):
+				return False
+			settings,change_seq,md5 = state
+			if settings != self.settings():
+				return False
+			if change_seq != seq:
+				logging.info("Changes since last dump: {changes}".format(changes=self.database.get_changes(change_seq)))
+				return False
+			if md5 != self.file_md5(filename):
+				logging.info("{file} was modified since last dump".format(file=filename))
+				return False
+		return True
+
+	def record_dump(self, files, seq):
+		'''Record the md5 checksum of the written files in the database (dump_state) and in a .md5 file next to each dump,
+			the change log up to the dumped state is pruned'''
+		for filename in files:
+			md5 = self.file_md5(filename)
+			logging.info("{file} md5: {md5}".format(file=filename,md5=md5))
+			with open(filename+".md5","w") as md5file:
+				print(md5, os.path.basename(filename), sep="  ", file=md5file)
+			try:
+				self.database.set_dump_state(os.path.abspath(filename),self.settings(),seq,md5)
+			except sqlite3.OperationalError as e:
+				logger.warning("The dump state of {file} could not be recorded ({e})".format(file=filename,e=e))
+		try:
+			self.database.prune_changes(seq)  ## The recorded dumps only compare seq, the logged rows are no longer needed
+		except sqlite3.OperationalError as e:
+			logger.warning("The change log could not be pruned ({e})".format(e=e))
+
+	def dump(self):
+		'''Write nodes and names at the same time, the shared remap is prepared once and nodes is
+			written by a separate process while this process writes names (formatting the lines holds
+			the GIL, so threads would not overlap), each from its own read-only connection. Writing is skipped
+			when the files are unchanged since the last recorded dump. Without track_changes the
+			change tracking triggers are removed from the database and the files are always written
+
+		------
+		Returns
+			boolean - True if the files were written
+		'''
+		files = [self.output_file(self.prefix[1]),self.output_file(self.prefix[0])]
+		try:
+			if self.track_changes:
+				self.database.track_changes()
 			else:
-				lmax,child_w_dpi = self.unique_indexes()
-			links = self.get_links('tree','child,parent,rank')
-			for link in links:
-				link = list(link)
-				'''If child with duplicate index, make sure link has unique index, match with node'''
-				if link[0] in child_w_dpi:
-					try:
-						checklist[link[0]] += 1
-						name = self.nodeDict[link[0]]
-						'''Update node index to uniqe'''
-						link[0] = lmax+100+len(checklist.keys())+checklist[link[0]]
-						self.nodeDict[link[0]] = name
-						self.updated = True
-					except KeyError:
-						checklist[link[0]] = 0
-						## Do nothing
-				if self.link_order:
-					link[0],link[1] = link[1],link[0]
+				self.database.untrack_changes()
+		except sqlite3.OperationalError as e:
+			logger.warning("Changes to {database} cannot be tracked ({e})".format(database=self.database.database,e=e))
+		seq = self.database.change_seq()
+		if self.track_changes and self.unchanged(files,seq):
+			logging.info("The database is unchanged since the last dump to {files}, nothing was written".format(files=", ".join(files)))
+			return False
+		self.prepare()
+		with ProcessPoolExecutor(max_workers=1) as executor:
+			job = executor.submit(self.nodes)
+			self.names()
+			job.result()
+		if self.track_changes:
+			self.record_dump(files,seq)
+		return True
+
+	def nodes(self):
+		'''Write database tree to nodes.dmp, links are streamed from the database and written through a buffered writer'''
+		logging.info('Write tree to: {}'.format(self.output_file(self.prefix[1])))
+		if self.remap is None:
+			self.prepare()
+		extra = []
+		if self.dbprogram in ["bracken"]:
+			extra += ["-"]
+		if self.dbprogram == "kraken2":
+			extra += ["",""] ## Make sure to add enough extra columns so that kraken2 does not trim away nessesary columns
+		if not self.minimal:
+			extra += [""]
+		columns = [1,0,2] if self.link_order else [0,1,2]
+		line = self.line_template(columns,extra)
+		QUERY = "SELECT child,parent,rank,tree.rowid FROM tree JOIN (rank) on rank.rank_i = tree.rank_i ORDER BY tree.rowid"
+		conn = self.connect()
+		try:
+			with self.open_output(self.prefix[1]) as outputfile:
+				## Retrieve all links that exists in the database
+				links = self.iter_query(QUERY,conn)
 				if self.dump_descriptions:
-					link[0],link[1] = self.nodeDict[link[0]],self.nodeDict[link[1]]
-				if self.dbprogram in ["bracken"]:
-					link = list(link)+["-"]
-				if self.dbprogram == "kraken2":
-					link = list(link)+["",""] ## Make sure to add enough extra columns so that kraken2 does not trim away nessesary columns
-				if not self.minimal:
-					link = list(link)+[""]
-				print(*link, sep=self.separator, end="\n", file=outputfile)
+					outputfile.write("child\tparent\trank\n")
+					nodeDict = self.nodeDict
+					links = ((nodeDict[child],nodeDict[parent],rank) for child,parent,rank,rowid in links)
+				elif len(self.remap) > 0:
+					remap = self.remap
+					links = ((remap.get(rowid,child),parent,rank) for child,parent,rank,rowid in links)
+				outputfile.writelines(starmap(line,links))
+		finally:
+			conn.close()
 
 	def names(self):
 		'''Write node annotations to names.dmp'''
-		logging.info('Write annotations to: {}{}.dmp'.format(self.path,self.prefix[0]))
+		logging.info('Write annotations to: {}'.format(self.output_file(self.prefix[0])))
 		end = "\n"
 		if self.dbprogram in ["krakenuniq","kraken2"]:
 			end = "\t|\n"
-		with open('{}{}.dmp'.format(self.path,self.prefix[0]),"w") as outputfile:
-			## Retrieve all nodes that exists in the database
-			if self.updated:
-				nodes = self.nodeDict.items()
-			else:
-				nodes = self.get_all('nodes', 'id,name')
+		extra = []
+		if not self.minimal:
 			empty = ""
-			for node in nodes:
-				if not self.minimal:
-					empty = ""
-					if self.dbprogram == "bracken":
-						empty = "-"
-					node = list(node) + [empty,"scientific name"]
-				print(*node, sep=self.separator, end=end, file=outputfile)
+			if self.dbprogram == "bracken":
+				empty = "-"
+			extra = [empty,"scientific name"]
+		line = self.line_template([0,1],extra,end)
+		conn = self.connect()
+		try:
+			with self.open_output(self.prefix[0]) as outputfile:
+				## Retrieve all nodes that exists in the database
+				if self.updated:
+					nodes = self.nodeDict.items()
+				else:
+					nodes = self.iter_query("SELECT id,name FROM nodes",conn)
+				outputfile.writelines(starmap(line,nodes))
+		finally:
+			conn.close()
+
+	def dump_binary(self, filename="taxonomy.ftb"):
+		'''Write the database to a binary columnar taxonomy (see BinaryTaxonomy), parent and rank are
+			fixed width columns indexed by the sorted node ids and names are stored in one string block
+			with an offset table, so the file can be memory mapped without parsing
+
+		------
+		Returns
+			int - number of nodes written
+		'''
+		filename = self.path+filename
+		logging.info('Write binary taxonomy to: {}'.format(filename))
+		index = self.database.tree_index()
+		if index.extra_links:
+			logger.warning("{n} links to nodes that already have a parent are not part of the binary taxonomy, only the first parent of each node is kept".format(n=len(index.extra_links)))
+		ids = index.ids
+		parents = array("i",(ids[parent] if parent >= 0 else -1 for parent in index.parents))
+		for node in index.self_links:
+			parents[index.row(node)] = node			## The root is its own parent as in nodes.dmp
+		conn = self.connect()
+		try:
+			rank_names = list(self.iter_query("SELECT rank_i,rank FROM rank ORDER BY rank_i",conn))
+			def names():
+				'''Merge the annotated nodes into the ids, nodes only present in the tree get an empty name'''
+				nodes = self.iter_query("SELECT id,name FROM nodes ORDER BY id",conn)
+				node = next(nodes,None)
+				for id in ids:
+					if node is not None and node[0] == id:
+						yield node[1] or ""
+						node = next(nodes,None)
+					else:
+						yield ""
+			return write_binary(filename,ids,parents,index.ranks,names(),rank_names)
+		finally:
+			conn.close()
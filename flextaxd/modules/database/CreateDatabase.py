@@ -18,6 +18,8 @@ class CreateDatabase(object):
     def __init__(self, verbose=False):
         super().__init__()
         self.verbose=verbose
+        ## Stored as PRAGMA user_version, databases with a lower version are migrated on connect
+        self.schema_version = 3
         self.sql_create_nodes_table = """ CREATE TABLE IF NOT EXISTS nodes (
                                             id integer PRIMARY KEY,
                                             name text NOT NULL
@@ -45,6 +47,46 @@ class CreateDatabase(object):
                                             FOREIGN KEY (id) REFERENCES nodes (id)
                                         ); """
 
+        ## Optional closure table (ancestor, descendant, depth), see DatabaseFunctions.build_closure
+        self.sql_create_closure_table = """CREATE TABLE IF NOT EXISTS tree_closure (
+                                        ancestor integer NOT NULL,
+                                        descendant integer NOT NULL,
+                                        depth integer NOT NULL,
+                                        PRIMARY KEY (ancestor, descendant)
+                                    ) WITHOUT ROWID;"""
+
+        self.sql_create_closure_index = """CREATE INDEX IF NOT EXISTS tree_closure_descendant ON tree_closure (descendant, depth);"""
+
+        ## Lookup indexes, tree.parent is already covered by the unique (parent, child, rank_i) constraint
+        self.sql_create_indexes = [
+            """CREATE INDEX IF NOT EXISTS tree_child_index ON tree (child, parent);""",
+            """CREATE INDEX IF NOT EXISTS genomes_id_index ON genomes (id);""",
+            """CREATE INDEX IF NOT EXISTS nodes_name_index ON nodes (name COLLATE NOCASE);""",
+            """CREATE INDEX IF NOT EXISTS genomes_reference_index ON genomes (reference);""",
+        ]
+
+        ## Change tracking (schema version 2), the triggers logging changes to the dumped tables are added by the first dump
+        ## (see DatabaseFunctions.track_changes) so that building a database is not slowed down by them
+        self.sql_create_change_log_table = """CREATE TABLE IF NOT EXISTS change_log (
+                                        seq integer PRIMARY KEY AUTOINCREMENT,
+                                        tbl text NOT NULL,
+                                        id integer
+                                    );"""
+
+        self.sql_create_dump_state_table = """CREATE TABLE IF NOT EXISTS dump_state (
+                                        file text PRIMARY KEY,
+                                        settings text,
+                                        change_seq integer NOT NULL,
+                                        md5 text,
+                                        dumped text
+                                    );"""
+
+        self.sql_create_change_triggers = []
+        for table,key in [("nodes","id"),("tree","child"),("rank","rank_i")]:
+            for event,row in [("INSERT","NEW"),("UPDATE","NEW"),("DELETE","OLD")]:
+                self.sql_create_change_triggers.append("""CREATE TRIGGER IF NOT EXISTS {table}_{event}_log AFTER {event} ON {table}
+                                        BEGIN INSERT INTO change_log(tbl,id) VALUES ('{table}',{row}.{key}); END;""".format(table=table,event=event.lower(),row=row,key=key))
+
     def create_connection(self,db_file):
         """ create a database connection to the SQLite database
             specified by db_file
@@ -75,9 +117,85 @@ class CreateDatabase(object):
         self.conn.commit()
         return
 
-    def create_database(self,database=False):
-        # create a database connection
-        self.conn = self.create_connection(database)
+    def get_version(self,conn):
+        """ get the schema version of a database
+        :param conn: Connection object
+        :return: int schema version (0 for databases created before versioning)
+        """
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def create_indexes(self,conn):
+        """ create the lookup indexes (if they do not exist)
+        :param conn: Connection object
+        """
+        for index in self.sql_create_indexes:
+            conn.execute(index)
+
+    def missing_indexes(self,conn):
+        """ get the lookup indexes that are not in the database
+        :param conn: Connection object
+        :return: list of CREATE INDEX statements
+        """
+        existing = set(name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type='index'"))
+        return [index for index in self.sql_create_indexes if index.split("EXISTS")[1].split()[0] not in existing]
+
+    def create_change_tracking(self,conn):
+        """ create the change log and dump state tables (if they do not exist)
+        :param conn: Connection object
+        """
+        conn.execute(self.sql_create_change_log_table)
+        conn.execute(self.sql_create_dump_state_table)
+
+    def create_change_triggers(self,conn):
+        """ create the triggers logging changes to nodes, tree and rank (if they do not exist)
+        :param conn: Connection object
+        """
+        self.create_change_tracking(conn)
+        for trigger in self.sql_create_change_triggers:
+            conn.execute(trigger)
+
+    def drop_change_triggers(self,conn):
+        """ drop the triggers logging changes to nodes, tree and rank
+        :param conn: Connection object
+        """
+        for trigger in self.sql_create_change_triggers:
+            name = trigger.split("EXISTS")[1].split()[0]
+            conn.execute("DROP TRIGGER IF EXISTS {trigger}".format(trigger=name))
+
+    def upgrade_database(self,conn):
+        """ migrate an existing database in place to the current schema version
+            version 1: lookup indexes
+            version 2: change log and dump state
+            version 3: genomes reference index (sorted genome dumps)
+            lookup indexes missing from a database of any version are recreated
+        :param conn: Connection object
+        :return: boolean True if the database was upgraded
+        """
+        version = self.get_version(conn)
+        if version >= self.schema_version:
+            missing = self.missing_indexes(conn)
+            if not missing:
+                return False
+            logger.info("Recreate {n} missing lookup indexes".format(n=len(missing)))
+            for index in missing:
+                conn.execute(index)
+            conn.commit()
+            return True
+        logger.info("Upgrade database schema from version {old} to {new}".format(old=version,new=self.schema_version))
+        if version < 3:
+            self.create_indexes(conn)
+        if version < 2:
+            self.create_change_tracking(conn)
+        conn.execute("PRAGMA user_version = {version}".format(version=int(self.schema_version)))
+        conn.commit()
+        return True
+
+    def create_database(self,database=False,conn=None):
+        # create a database connection (or use an open connection, e.g. to an in-memory database)
+        if conn is not None:
+            self.conn = conn
+        else:
+            self.conn = self.create_connection(database)
         if self.conn is not None:
             # create nodes table
             self.create_table(self.sql_create_nodes_table)
@@ -87,6 +205,8 @@ class CreateDatabase(object):
             self.create_table(self.sql_create_genomes_table)
             # create rank tables
             self.create_table(self.sql_create_rank_table)
+            # create lookup indexes and set schema version
+            self.upgrade_database(self.conn)
 
             self.conn.commit()
         else:
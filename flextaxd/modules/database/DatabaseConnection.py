@@ -2,8 +2,19 @@ import sys
 import os
 import sqlite3
 import logging
+from itertools import islice
+from .CreateDatabase import CreateDatabase
+from .TreeIndex import TreeIndex
 logger = logging.getLogger(__name__)
 
+def batched(iterable,size):
+	'''Split an iterable into lists of at most size items'''
+	iterator = iter(iterable)
+	batch = list(islice(iterator,size))
+	while batch:
+		yield batch
+		batch = list(islice(iterator,size))
+
 class ConnectionError(Exception):
 	def __init__(self, value):
 		self.value = value
@@ -24,21 +35,91 @@ class TreeError(Exception):
 
 class DatabaseConnection(object):
 	"""docstring for DatabaseConnection"""
-	def __init__(self, database, verbose=False):
+	def __init__(self, database, verbose=False, staging=False):
 		super().__init__()
 		self.verbose = verbose
 		self.database = database
-		BASE_DIR = os.path.dirname(os.path.abspath(__file__))  ## Retrieve path
-		if not os.path.exists(self.database):
-			if self.verbose:
-				logger.debug("python {path}/CreateDatabase.py {database}".format(path=BASE_DIR,database=self.database))
-			os.system("python {path}/CreateDatabase.py {database}".format(path=BASE_DIR,database=self.database))
+		self.staging = staging
+		if not os.path.exists(self.database) and not self.staging:
+			logger.debug("Create database {database}".format(database=self.database))
+			CreateDatabase(verbose=verbose).create_database(self.database)
 		try: ## If database connection already exists
 			self.conn
 		except AttributeError:
-			logger.debug("Connecting to {database}".format(database=self.database))
-			self.conn = self.connect(self.database)
+			if self.staging:
+				self.conn = self.connect_staging(self.database,self.staging)
+			else:
+				logger.debug("Connecting to {database}".format(database=self.database))
+				self.conn = self.connect(self.database)
 			self.cursor = self.create_cursor(self.conn)
+			self.upgrade()
+
+	def connect_staging(self,database,staging=":memory:"):
+		'''Create a staging database in memory (:memory:) or in a directory (e.g. a tmpfs like /dev/shm),
+			an existing database is copied into the staging database. The staged database is written
+			to the database file with persist()
+
+		------
+		Returns
+			connection object (sqlite3)
+		'''
+		if not hasattr(sqlite3.Connection,"backup"):
+			raise ConnectionError("A staging database requires python 3.7 or later (sqlite3 backup)")
+		if staging != ":memory:":
+			staging = os.path.join(staging,os.path.basename(database)+".staging")
+			if os.path.exists(staging):
+				os.remove(staging)
+		logger.info("Stage database {database} in {staging}".format(database=database,staging=staging))
+		self.conn = self.connect(staging)
+		if os.path.exists(database):
+			source = sqlite3.connect(database)
+			source.backup(self.conn)
+			source.close()
+		else:
+			CreateDatabase(verbose=self.verbose).create_database(conn=self.conn)
+		self.staging = staging
+		return self.conn
+
+	def persist(self):
+		'''Write a staged database to the database file in one backup, the file is replaced
+			only once the copy is complete. The staging copy is removed and the connection
+			continues on the database file
+
+		------
+		Returns
+			boolean - True if a staged database was written
+		'''
+		self.commit()
+		if not self.staging:
+			return False
+		logger.info("Write staged database to {database}".format(database=self.database))
+		tmp = self.database+".tmp"
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		target = sqlite3.connect(tmp)
+		self.conn.backup(target)
+		target.close()
+		os.replace(tmp,self.database)
+		self.conn.close()
+		if self.staging != ":memory:":
+			os.remove(self.staging)
+		self.staging = False
+		self.conn = self.connect(self.database)
+		self.cursor = self.create_cursor(self.conn)
+		return True
+
+	def upgrade(self):
+		'''Migrate databases created with an older schema version in place (adds missing indexes and change tracking)
+
+		------
+		Returns
+			boolean - True if the database was upgraded
+		'''
+		try:
+			return CreateDatabase().upgrade_database(self.conn)
+		except sqlite3.OperationalError as e:
+			logger.warning("Database {database} could not be upgraded ({e}), continue without indexes and change tracking".format(database=self.database,e=e))
+		return False
 
 	def __str__(self):
 		return "Object of class DatabaseConnection, connected to {database}".format(database=self.database)
@@ -88,6 +169,39 @@ class DatabaseConnection(object):
 	def commit(self):
 		self.conn.commit()
 
+	def set_fast_import(self,fast=True,cache_size=1000000):
+		'''Tune the connection for building a database. Journaling and syncing is turned off, the
+			database is locked to this connection during the import. The lookup indexes are kept since the
+			import looks up names and links, turning it off restores durable settings and updates statistics (ANALYZE).
+
+		Parameters
+			boolean - fast import on/off
+			int     - page cache size in KiB while importing
+
+		------
+		Returns
+			boolean - fast import state
+		'''
+		self.commit()
+		if fast:
+			logger.info("Fast import mode on")
+			self.conn.execute("PRAGMA journal_mode = OFF")
+			self.conn.execute("PRAGMA synchronous = OFF")
+			self.conn.execute("PRAGMA cache_size = -{size}".format(size=int(cache_size)))
+			self.conn.execute("PRAGMA temp_store = MEMORY")
+			self.conn.execute("PRAGMA locking_mode = EXCLUSIVE")
+		else:
+			logger.info("Fast import finished, restore durable settings and analyze database")
+			self.conn.execute("PRAGMA journal_mode = DELETE")
+			self.conn.execute("PRAGMA synchronous = FULL")
+			self.conn.execute("PRAGMA cache_size = -2000")
+			self.conn.execute("PRAGMA temp_store = DEFAULT")
+			self.conn.execute("PRAGMA locking_mode = NORMAL")
+			self.conn.execute("ANALYZE")  ## Also releases the exclusive lock (requires a read after locking_mode NORMAL)
+			self.commit()
+		self.fast_import = fast
+		return self.fast_import
+
 	def query(self,query,insert_val = False, cursor=False,error=False):
 		'''The query function is a wrapper around sqlite3 execute to form responses related to the request
 
@@ -117,6 +231,21 @@ class DatabaseConnection(object):
 				sys.stderr.write(str(e)+"\n")
 			return(e)
 
+	def executemany(self,query,rows):
+		'''The executemany function is a wrapper around sqlite3 executemany for bulk statements
+
+		Returns
+			int - 	number of rows changed by the statement
+		'''
+		changes = self.conn.total_changes
+		try:
+			self.cursor.executemany(query,rows)
+		except Exception as e:
+			logger.warning("Error in DatabaseConnection executemany")
+			logger.warning(query)
+			raise
+		return self.conn.total_changes - changes
+
 	def insert(self,data,table):
 		'''Insert function
 				data is a dictionary with keys matching
@@ -159,31 +288,43 @@ class DatabaseConnection(object):
 			return False
 		return True
 
-	def multi_update(self,data,table):
-		'''Update function requires table column which column to identify row with and value to replace
+	def multi_update(self,data,table,hold=False,batch_size=100000):
+		'''Update function requires table column which column to identify row with and value to replace,
+			rows are upserted (INSERT ... ON CONFLICT DO UPDATE) with bound parameters in batches with one
+			transaction per batch, the where_column must be unique in table
 		Parameters
-			list - data in form of a list with updates
+			dict - set_column, where_column and data, an iterable of (set_value, where_value) rows
 			table - which table to update
 		------
 		Returns
-			boolean - 	True: if rowcount of update is not zero
-						False if column is not set (value is inserted)
+			int - number of rows added
+			int - number of existing rows where the value was replaced (rows set to their current value are not counted)
 		'''
 		UPDATE_QUERY = '''
 			INSERT INTO {table} ({set_column},{where_column})
-			VALUES {data}
+			VALUES (?,?)
 			ON CONFLICT({where_column}) DO UPDATE SET
-			{where_column} = {where_column},
-			{set_column}   = {set_column};
-		'''.format(table=table,set_column=data["set_column"],where_column=data["where_column"],data=",".join(data["data"]))
-		#udata = tuple([data["set_value"],data["where"]])
+			{set_column} = excluded.{set_column}
+		'''.format(table=table,set_column=data["set_column"],where_column=data["where_column"])
+		COUNT_QUERY = '''SELECT count(*),count({table}.{where_column}),
+			sum({table}.{where_column} IS NOT NULL AND {table}.{set_column} IS NOT temp_update.set_value)
+			FROM temp_update LEFT JOIN {table} ON {table}.{where_column} = temp_update.value'''.format(table=table,set_column=data["set_column"],where_column=data["where_column"])
 		logger.debug("{q}".format(q=UPDATE_QUERY))
-		#exit()
-		res = self.query(UPDATE_QUERY,error=True)
-		#if self.rowcount() == 0:
-		#	res = self.insert({data["set_column"]:data["set_value"],data["where_column"]:data["where"]}, table)
-		#	return False
-		return True
+		added,updated = 0,0
+		self.cursor.execute("DROP TABLE IF EXISTS temp.temp_update")
+		self.cursor.execute("CREATE TEMP TABLE temp_update (value PRIMARY KEY, set_value)")
+		for batch in batched(data["data"],batch_size):
+			## Count the new and the replaced rows of the batch with one join (the last row of a repeated value wins as in the upsert)
+			self.cursor.execute("DELETE FROM temp_update")
+			self.cursor.executemany("INSERT OR REPLACE INTO temp_update(set_value,value) VALUES (?,?)",batch)
+			rows,existing,replaced = self.query(COUNT_QUERY).fetchone()
+			self.executemany(UPDATE_QUERY,batch)
+			added += rows - existing
+			updated += replaced or 0
+			## Commit changes
+			if not hold:
+				self.commit()
+		return added,updated
 
 	def delete(self,nodes,table):
 		'''Deleting a node should make sure all related data is also removed
@@ -208,94 +349,191 @@ class DatabaseConnection(object):
 			int - cursor rowcount'''
 		return self.cursor.rowcount
 
+	def temp_ids(self,ids,table="temp_ids"):
+		'''Load a set of integer ids into an indexed TEMP table so that large sets
+			can be joined against instead of being inlined into the query
+
+		------
+		Returns
+			str - name of the temp table
+		'''
+		self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS {table} (id integer PRIMARY KEY)".format(table=table))
+		self.cursor.execute("DELETE FROM {table}".format(table=table))
+		self.cursor.executemany("INSERT OR IGNORE INTO {table}(id) VALUES (?)".format(table=table),((int(i),) for i in ids))
+		return table
+
+	def temp_values(self,values,table="temp_values"):
+		'''Load a set of text values (e.g. genome ids) into an indexed TEMP table, see temp_ids
+
+		------
+		Returns
+			str - name of the temp table
+		'''
+		self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS {table} (value text PRIMARY KEY)".format(table=table))
+		self.cursor.execute("DELETE FROM {table}".format(table=table))
+		self.cursor.executemany("INSERT OR IGNORE INTO {table}(value) VALUES (?)".format(table=table),((str(v),) for v in values))
+		return table
+
+	def end_read(self,held):
+		'''End the transaction that loading a TEMP table opened for a read, otherwise the connection keeps
+			its read lock on the database until the next commit. A transaction the caller already held is kept
+
+		Parameters
+			held - conn.in_transaction before the TEMP table was loaded
+
+		------
+		Returns
+			boolean - True if the transaction was ended
+		'''
+		if held or not self.conn.in_transaction:
+			return False
+		self.commit()
+		return True
+
 class DatabaseFunctions(DatabaseConnection):
 	"""DatabaseFunctions class defines additional functions to the DatabaseConnection class
 
 	"""
-	def __init__(self, database, verbose=False):
-		super().__init__(database, verbose)
+	def __init__(self, database, verbose=False, staging=False):
+		super().__init__(database, verbose, staging)
 		logger.debug("Load DatabaseFunctions")
+		self.closure = self.table_exists("tree_closure")  ## Maintain the closure table only if it was built for this database
+
+	def table_exists(self,table):
+		'''Check if a table exists in the database
+
+		------
+		Returns
+			boolean
+		'''
+		QUERY = "SELECT name FROM sqlite_master WHERE type='table' AND name = ?"
+		return self.query(QUERY,insert_val=(table,),error=True).fetchone() is not None
+
+	'''Closure table functions'''
+	def build_closure(self,maxdepth=1000):
+		'''(Re)build the tree_closure table in bulk, one row per ancestor/descendant pair
+			including the node itself (depth 0). Trees deeper than maxdepth are cut.
+
+		------
+		Returns
+			int - number of rows in the closure table
+		'''
+		logger.info("Build tree closure table")
+		schema = CreateDatabase()
+		self.query("DROP TABLE IF EXISTS tree_closure")
+		self.query(schema.sql_create_closure_table)
+		QUERY = '''INSERT INTO tree_closure(ancestor,descendant,depth)
+				WITH RECURSIVE closure(ancestor,descendant,depth) AS (
+					SELECT child,child,0 FROM tree UNION SELECT parent,parent,0 FROM tree
+					UNION ALL
+					SELECT closure.ancestor,tree.child,closure.depth+1 FROM closure
+						JOIN tree ON tree.parent = closure.descendant
+						WHERE tree.child != tree.parent AND closure.depth < {maxdepth}
+				) SELECT ancestor,descendant,depth FROM closure WHERE true
+				ON CONFLICT(ancestor,descendant) DO UPDATE SET depth=min(depth,excluded.depth)'''.format(maxdepth=int(maxdepth))
+		logger.debug(QUERY)
+		self.query(QUERY)
+		self.query(schema.sql_create_closure_index)
+		self.commit()
+		self.closure = True
+		rows = self.num_rows("tree_closure")
+		logger.info("Closure table built with {rows} rows".format(rows=rows))
+		return rows
+
+	def closure_add_links(self,links):
+		'''Add closure rows for new links, all ancestors of the parent are connected to all descendants of the child.
+			A pair reached through several paths keeps its shortest depth
+
+		------
+		Returns
+			boolean
+		'''
+		links = [(int(parent),int(child)) for parent,child,rank in links if parent != child]
+		self.cursor.executemany("INSERT OR IGNORE INTO tree_closure(ancestor,descendant,depth) VALUES (?,?,0)",((node,) * 2 for link in links for node in link))
+		QUERY = '''INSERT INTO tree_closure(ancestor,descendant,depth)
+				SELECT a.ancestor,d.descendant,a.depth+d.depth+1 FROM tree_closure a, tree_closure d
+					WHERE a.descendant = ? AND d.ancestor = ?
+				ON CONFLICT(ancestor,descendant) DO UPDATE SET depth=min(depth,excluded.depth)'''
+		self.cursor.executemany(QUERY,links)
+		return True
+
+	def closure_delete_links(self,children,maxdepth=1000):
+		'''Update the closure table after links were removed from the tree, the ancestors of every node
+			below the children of the deleted links are resolved again from the remaining links in one query.
+			Nothing is committed, the caller commits together with the deleted links
+
+		------
+		Returns
+			boolean
+		'''
+		children = self.temp_ids(children,table="temp_closure_c")
+		descendants = self.temp_ids([],table="temp_closure_d")
+		self.query('''INSERT OR IGNORE INTO {d}(id) SELECT descendant FROM tree_closure
+					WHERE ancestor IN (SELECT id FROM {c})'''.format(c=children,d=descendants))
+		self.query("DELETE FROM tree_closure WHERE descendant IN (SELECT id FROM {d}) AND depth > 0".format(d=descendants))
+		QUERY = '''INSERT INTO tree_closure(ancestor,descendant,depth)
+				WITH RECURSIVE closure(ancestor,descendant,depth) AS (
+					SELECT id,id,0 FROM {d}
+					UNION
+					SELECT tree.parent,closure.descendant,closure.depth+1 FROM closure
+						JOIN tree ON tree.child = closure.ancestor
+						WHERE tree.child != tree.parent AND closure.depth < {maxdepth}
+				) SELECT ancestor,descendant,depth FROM closure WHERE depth > 0
+				ON CONFLICT(ancestor,descendant) DO UPDATE SET depth=min(depth,excluded.depth)'''.format(d=descendants,maxdepth=int(maxdepth))
+		logger.debug(QUERY)
+		self.query(QUERY)
+		return True
+
+	def tree_index(self):
+		'''Load the tree table into a compact in memory index, see TreeIndex. The index is a snapshot,
+			load a new index after modifying the tree
+
+		------
+		Returns
+			TreeIndex
+		'''
+		return TreeIndex.from_database(self)
 
 	'''Validate tree function'''
 	def validate_tree(self):
-		'''This function validates the tree structure in the databases
-			1. All nodes must only have one parent (check_parent)
-			2. All edges must be attatched to the tree (match tree links and edges)
-			3. All nodes must be attatched to the tree (match tree nodes and nodes)
-			4. All nodes from links must have a node description (match the number of nodes from links with number of annotated nodes)
+		'''This function validates the tree structure in the databases, the tree is loaded into a TreeIndex
+			and validated in one pass over the parent array (see TreeIndex.validate), the report
+			is kept in tree_report
+			1. Nodes with multiple parents are allowed in different lineages, not twice at the same rank
+			2. All edges must be attatched to the tree
+			3. All nodes must be attatched to the tree, nodes in cycles are not
+			4. All nodes from links must have a node description
 
 		------
 		Returns
-			True: if all edges has one and only one parent
+			True: if the tree is valid
 		'''
-		self.taxonomy = self.get_nodes()
-
-		logger.info("Get all database nodes")
-		self.nodes = self.get_nodes(col=1)					## get all nodes
-		logger.info("Get all database edges")
-		self.edges = self.get_links()					## Get all links
-		logger.info("Get all children from root node")
-		self.tree_connections = self.get_children([1])  ## Get all chilren from root
-		logger.info("Get tree edges from children")
-		self.tree_links = self.get_links(self.tree_connections) ## get all links from rooted tree
-		logger.info("Get nodes from tree edges")
-		self.tree_nodes = set()
-		for edge in self.edges:
-			self.tree_nodes.add(edge[0])
-			self.tree_nodes.add(edge[1])
-		logger.info("Validate parents")
-		res = self.check_parent()
-		extra = ""
-		if len(res) > 0:
-			failed_nodes = [self.nodes[x[0]] for x in list(res)]
-			logger.debug(failed_nodes)
-			if len(failed_nodes) > 10:
-				logger.info(failed_nodes[:10])
-				failed_nodes = len(failed_nodes)
-				extra = "total failed nodes: "
-			raise TreeError("There are nodes with multiple parents {extra}{nodes}".format(nodes=failed_nodes,extra=extra))
-		stats = """Tree statistics
-					Nodes: {nodes}
-					Links: {links}
-					Tree: n({tnodes}), l({tlinks})
-					LinkNodes: {link_nodes}
-					Parent_ok: True
-					""".format(nodes = len(self.nodes),
-								links=len(self.edges),
-								tnodes=len(self.tree_connections),
-								tlinks = len(self.tree_links),
-								link_nodes = len(self.tree_nodes)
-		)
-		logger.info(stats)
-		nodeset = set(self.nodes.keys())
-		if len(nodeset - self.tree_connections) != 0:
-			lset = nodeset - self.tree_connections
-			if len(lset) > 10:
-				lset = len(lset)
-				#logger.debug([self.taxonomy[x] for x in lset])
-			logger.info("{}".format(lset))
+		report = self.tree_index().validate()
+		self.tree_report = report
+		logger.info(report)
+		logger.debug("Nodes per depth: {depths}".format(depths=report.depths))
+		def summary(nodes):
+			return len(nodes) if len(nodes) > 10 else nodes
+		if len(report.rank_conflicts) > 0:
+			logger.error("Nodes with two parents have identical ranks, Fatal Error")
+			logger.debug(report.rank_conflicts)
+			extra = "total failed nodes: " if len(report.rank_conflicts) > 10 else ""
+			raise TreeError("There are nodes with multiple parents {extra}{nodes}".format(nodes=summary(report.rank_conflicts),extra=extra))
+		if len(report.multi_parents) > 0:
+			logger.info("Found: {n} nodes with multiple parents, however in different lineages, OK.".format(n=len(report.multi_parents)))
+			logger.debug(report.multi_parents)
+		if len(report.cycles) > 0:
+			logger.info("Cycles: {}".format(summary(report.cycles)))
+			raise TreeError("There are {n} cycles in the tree!".format(n=len(report.cycles)))
+		if len(report.orphans) > 0:
+			logger.info("{}".format(summary(report.orphans)))
 			raise TreeError("The number of nodes and the number nodes under root does not match!")
-		if len(set(self.edges) - set(self.tree_links)) != 0:
-			lset = set(self.edges) - set(self.tree_links)
-			if len(lset) > 10:
-				lset = len(lset)
-				#logger.debug([self.taxonomy[x] for x in lset])
-			logger.info("{}".format(lset))
+		if report.detached_links > 0:
+			logger.info("{}".format(report.detached_links))
 			raise TreeError("The number of edges and the number edges under root does not match!")
-		if len(self.tree_nodes - nodeset) != 0:
-			lset = self.tree_nodes - nodeset
-			if len(lset) > 10:
-				lset = len(lset)
-				#logger.debug([self.taxonomy[x] for x in lset])
-			logger.info("{}".format(lset))
+		if len(report.unannotated) > 0:
+			logger.info("{}".format(summary(report.unannotated)))
 			raise TreeError("The number of annotated nodes does not match with the number of nodes connected to edges!")
-		if len(self.tree_connections - nodeset) != 0:
-			lset = self.tree_connections - nodeset
-			if len(lset) > 10:
-				lset = len(lset)
-				#logger.debug([self.taxonomy[x] for x in lset])
-			logger.info("{}".format(lset))
-			raise TreeError("There are nodes in the database not connected to the tree")
 		logger.info("Validation OK!")
 		return True
 
@@ -454,6 +692,65 @@ class DatabaseFunctions(DatabaseConnection):
 		links = self.query(QUERY).fetchall()
 		return links
 
+	def iter_subtree(self,parents,maxdepth=None,rank=False,selected=False):
+		'''Stream all descendants of the given parents using one recursive query
+
+		Parameters
+			parents  - iterable of node ids to start from
+			maxdepth - number of levels to descend (None walks the whole subtree)
+			rank     - only return descendants linked to their parent with this rank_i
+			selected - only follow links of this rank_i from the given parents
+
+		------
+		Returns
+			iterator - node ids of the descendants, each node returned once
+		'''
+		nodes = ",".join(map(str,map(int,parents)))
+		if nodes == "" or (maxdepth is not None and maxdepth < 1):
+			return
+		if self.closure and not (rank or selected):
+			yield from self._closure_subtree(nodes,maxdepth)
+			return
+		anchor = "SELECT child,rank_i{depth} FROM tree WHERE parent in({nodes})"
+		if selected:
+			anchor += " AND rank_i = {selected}".format(selected=int(selected))
+		step = "SELECT tree.child,tree.rank_i{depth} FROM tree JOIN subtree ON tree.parent = subtree.node WHERE tree.child != tree.parent"
+		if maxdepth is not None:
+			## The depth column keeps the recursion bounded, the UNION on (node,rank_i) alone is enough to stop on cycles
+			columns = "node,rank_i,depth"
+			anchor = anchor.format(depth=",1",nodes=nodes)
+			step = step.format(depth=",subtree.depth+1") + " AND subtree.depth < {maxdepth}".format(maxdepth=int(maxdepth))
+		else:
+			columns = "node,rank_i"
+			anchor = anchor.format(depth="",nodes=nodes)
+			step = step.format(depth="")
+		QUERY = '''WITH RECURSIVE subtree({columns}) AS ({anchor} UNION {step})
+				SELECT DISTINCT node FROM subtree'''.format(columns=columns,anchor=anchor,step=step)
+		if rank:
+			QUERY += " WHERE rank_i = {rank}".format(rank=int(rank))
+		logger.debug(QUERY)
+		cursor = self.conn.cursor()  ## Separate cursor, the result is streamed while other queries may run
+		try:
+			for node in cursor.execute(QUERY):
+				yield node[0]
+		finally:
+			cursor.close()
+
+	def _closure_subtree(self,nodes,maxdepth=None):
+		'''Subtree lookup in the closure table, see iter_subtree'''
+		QUERY = '''SELECT DISTINCT descendant FROM tree_closure WHERE ancestor in({nodes}) AND depth > 0'''.format(nodes=nodes)
+		if maxdepth is not None:
+			QUERY += " AND depth <= {maxdepth}".format(maxdepth=int(maxdepth))
+		## Nodes linked to themselves (root) are part of their own subtree
+		QUERY += " UNION SELECT child FROM tree WHERE child = parent AND child in({nodes})".format(nodes=nodes)
+		logger.debug(QUERY)
+		cursor = self.conn.cursor()
+		try:
+			for node in cursor.execute(QUERY):
+				yield node[0]
+		finally:
+			cursor.close()
+
 	'''Add functions of class'''
 	def add_node(self, description, id=False, table="nodes"):
 		'''Add node to tree
@@ -503,7 +800,10 @@ class DatabaseFunctions(DatabaseConnection):
 			"rank_i": rank
 		}
 		logger.debug("link added:  child {}, parent {}, rank {} ".format(child,parent,rank))
-		return self.insert(info, table="tree")
+		res = self.insert(info, table="tree")
+		if self.closure and not isinstance(res,Exception):
+			self.closure_add_links([(parent,child,rank)])
+		return res
 
 	def add_genome(self, genome, _id=False,reference=False):
 		'''Add genome annotation to nodes
@@ -523,8 +823,8 @@ class DatabaseFunctions(DatabaseConnection):
 		logger.debug(info)
 		return self.insert(info, table="genomes")
 
-	def add_links(self,links, table="tree",hold=False):
-		'''Add links from a list to tree
+	def add_links(self,links, table="tree",hold=False,batch_size=100000):
+		'''Add links from a list to tree, links are inserted in batches with one transaction per batch
 
 		Returns
 		------
@@ -533,37 +833,97 @@ class DatabaseFunctions(DatabaseConnection):
 		'''
 		added_links = []
 		nodes = set()
-		for parent,child,rank in links:
-			#logger.debug("{} {} rank: {} link added!".format(parent,child,rank))
-			res = self.add_link(child,parent,rank,table=table)
-			### Check if the link already exist in the database, this overlap may occur when a large new branch is added
-			if "UNIQUE constraint failed" not in str(res):
+		self.query("CREATE TEMP TABLE IF NOT EXISTS temp_links (parent integer, child integer, rank_i integer)")
+		NEW_LINKS = '''SELECT DISTINCT parent,child,rank_i FROM temp_links
+					WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {table}.parent = temp_links.parent AND {table}.child = temp_links.child AND {table}.rank_i IS temp_links.rank_i)'''.format(table=table)
+		INSERT = "INSERT OR IGNORE INTO {table}(parent,child,rank_i) VALUES (?,?,?)".format(table=table)
+		for batch in batched(links,batch_size):
+			### Links already in the database are skipped, this overlap may occur when a large new branch is added
+			self.query("DELETE FROM temp_links")
+			self.executemany("INSERT INTO temp_links(parent,child,rank_i) VALUES (?,?,?)",batch)
+			new_links = self.query(NEW_LINKS).fetchall()
+			self.executemany(INSERT,new_links)
+			for parent,child,rank in new_links:
 				added_links.append([parent,child,rank])
 				nodes.add(parent)
 				nodes.add(child)
-		## Commit changes
-		if not hold:
-			self.commit()
+			if self.closure:
+				self.closure_add_links(new_links)
+			## Commit changes
+			if not hold:
+				self.commit()
+		logger.debug("{n} links added".format(n=len(added_links)))
 		return added_links,nodes
 
-	def add_nodes(self,nodes, table="tree",hold=False):
-		'''Add nodes from a list of nodes
+	def load_links(self,links, table="tree",hold=False,batch_size=100000):
+		'''Bulk load links (parent,child,rank_i) when building a database, unlike add_links the
+			added links are not tracked, links already in the database are skipped
 
 		Returns
 		------
-			int - number of nodes added ()
+			int - number of links added
+		'''
+		added_links = 0
+		INSERT = "INSERT OR IGNORE INTO {table}(parent,child,rank_i) VALUES (?,?,?)".format(table=table)
+		for batch in batched(links,batch_size):
+			added_links += self.executemany(INSERT,batch)
+			if self.closure:
+				self.closure_add_links(batch)  ## Links already in the tree keep their closure rows
+			## Commit changes
+			if not hold:
+				self.commit()
+		return added_links
+
+	def add_nodes(self,nodes, table="nodes",hold=False,batch_size=100000):
+		'''Add nodes from a list of names or (id,name) pairs, nodes are inserted in batches
+			with one transaction per batch, ids already in the database are skipped
+
+		Returns
+		------
+			int - number of nodes added
 		'''
 		added_nodes = 0
-		for node in nodes:
-			res = self.add_node(node)
-			### If the node already exist in the database
-			if "UNIQUE constraint failed" not in str(res):
-				added_nodes +=1
-		## Commit changes
-		if not hold:
-			self.commit()
+		INSERT = "INSERT OR IGNORE INTO {table}(id,name) VALUES (?,?)".format(table=table)
+		for batch in batched(nodes,batch_size):
+			rows = [(None,node) if isinstance(node,str) else node for node in batch]
+			added_nodes += self.executemany(INSERT,[row for row in rows if row[1].strip() != ""])
+			## Commit changes
+			if not hold:
+				self.commit()
 		return added_nodes
 
+	def add_genomes(self,genomes, table="genomes",hold=False,batch_size=100000):
+		'''Add genome annotations from a list of (genome,id,reference) rows, rows are inserted in batches
+			with one transaction per batch, genomes already in the database are skipped
+
+		Returns
+		------
+			int - number of genomes added
+		'''
+		added_genomes = 0
+		INSERT = "INSERT OR IGNORE INTO {table}(genome,id,reference) VALUES (?,?,?)".format(table=table)
+		for batch in batched(genomes,batch_size):
+			added_genomes += self.executemany(INSERT,[(genome,_id,reference if reference else None) for genome,_id,reference in batch])
+			## Commit changes
+			if not hold:
+				self.commit()
+		return added_genomes
+
+	def upsert_genomes(self,genomes, table="genomes",hold=False,batch_size=100000):
+		'''Add or update genome annotations from a list of (genome,id) rows, see multi_update
+
+		Returns
+		------
+			int - number of genomes added
+			int - number of genome annotations updated
+		'''
+		update = {
+			"set_column": "id",
+			"where_column": "genome",
+			"data": ((_id,genome) for genome,_id in genomes)
+		}
+		return self.multi_update(update,table,hold=hold,batch_size=batch_size)
+
 	'''Delete functions of class'''
 	def delete_links(self,links, table="tree",hold=False):
 		'''This function deletes all links given in links
@@ -573,13 +933,14 @@ class DatabaseFunctions(DatabaseConnection):
 			boolean
 		'''
 		logger.info("Slow clean")
-		QUERY = "DELETE FROM {table} WHERE parent = {parent} AND child = {child} AND rank_i = {rank_i}"
+		QUERY = "DELETE FROM {table} WHERE parent = ? AND child = ? AND rank_i IS ?".format(table=table)
 		logger.debug("Deleting {nlinks} links!".format(nlinks=len(links)))
-		logger.debug(QUERY.format(table=table,parent="",child="",rank_i=""))
+		logger.debug(QUERY)
 		logger.info("{links}".format(links=len(links)))
-		for parent,child,rank in links:
-			logger.debug("{}-{} rank: {} deleted!".format(parent,child,rank))
-			res = self.query(QUERY.format(table=table, parent=parent, child=child, rank_i=rank))
+		links = [(parent,child,rank) for parent,child,rank in links]
+		self.executemany(QUERY,links)
+		if self.closure:
+			self.closure_delete_links(set(child for parent,child,rank in links if parent != child))
 		## Commit changes
 		if not hold:
 			logger.debug("Commit changes!")
@@ -587,22 +948,23 @@ class DatabaseFunctions(DatabaseConnection):
 		return True
 
 	def fast_delete_links(self,links,table="tree",hold=False):
-		'''This function is used when general clean function is executed
+		'''This function is used when general clean function is executed, the (parent,child,rank) links
+			are loaded into a TEMP table and exactly those links are deleted in one join
 		Returns
 		------
 			boolean
 		'''
 		logger.info("Fast clean")
-		parents = set()
-		children = set()
-		QUERY = "DELETE FROM {table} WHERE parent in ({parents}) AND child in ({children})"
 		logger.debug("Deleting {nlinks} links!".format(nlinks=len(links)))
-		for parent,child,rank in links:
-			parents |= set([parent])
-			children |= set([child])
-			#logger.debug("{}-{} rank: {} deleted!".format(parent,child,rank))
-		logger.debug(QUERY.format(table=table,parents=len(parents),children=len(children)))
-		res = self.query(QUERY.format(table=table, parents=",".join(list(map(str,parents))), children=",".join(list(map(str,children)))))
+		self.query("CREATE TEMP TABLE IF NOT EXISTS temp_links (parent integer, child integer, rank_i integer)")
+		self.query("DELETE FROM temp_links")
+		self.executemany("INSERT INTO temp_links(parent,child,rank_i) VALUES (?,?,?)",links)
+		QUERY = '''DELETE FROM {table} WHERE rowid IN (SELECT {table}.rowid FROM temp_links JOIN {table}
+					ON {table}.child = temp_links.child AND {table}.parent = temp_links.parent AND {table}.rank_i IS temp_links.rank_i)'''.format(table=table)
+		logger.debug(QUERY)
+		res = self.query(QUERY)
+		if self.closure:
+			self.closure_delete_links(set(child for parent,child,rank in links))
 		## Commit changes
 		if not hold:
 			logger.debug("Commit changes!")
@@ -616,9 +978,12 @@ class DatabaseFunctions(DatabaseConnection):
 			boolean
 		'''
 		logger.info("Entered ambigious_delete_links")
-		QUERY = "DELETE FROM {table} WHERE parent in ({parents}) AND child in ({children})"
-		logger.info("Attempting delete where parent&child in: "+str(nodes))
-		res = self.query(QUERY.format(table='tree', parents=",".join(list(map(str,nodes))), children=",".join(list(map(str,nodes)))))
+		QUERY = "DELETE FROM {table} WHERE parent IN (SELECT id FROM {nodes}) AND child IN (SELECT id FROM {nodes})"
+		logger.info("Attempting delete where parent&child in {n} nodes".format(n=len(nodes)))
+		logger.debug(nodes)
+		res = self.query(QUERY.format(table='tree', nodes=self.temp_ids(nodes)))
+		if self.closure:
+			self.closure_delete_links(nodes)
 		## Commit changes
 		if not hold:
 			logger.debug("Commit changes!")
@@ -632,10 +997,13 @@ class DatabaseFunctions(DatabaseConnection):
 		------
 			boolean
 		'''
-		QUERY = "DELETE FROM {table} WHERE id in ({nodes})"
+		QUERY = "DELETE FROM {table} WHERE id IN (SELECT id FROM {nodes})"
 		logger.debug("Deleting {nnodes} nodes!".format(nnodes=len(nodes)))
-		logger.debug(QUERY.format(table=table,nodes=""))
-		res = self.query(QUERY.format(table=table, nodes=",".join(list(map(str,nodes)))))
+		temp_nodes = self.temp_ids(nodes)
+		logger.debug(QUERY.format(table=table,nodes=temp_nodes))
+		res = self.query(QUERY.format(table=table, nodes=temp_nodes))
+		if self.closure:
+			self.query("DELETE FROM tree_closure WHERE ancestor IN (SELECT id FROM {t}) OR descendant IN (SELECT id FROM {t})".format(t=temp_nodes))
 		## Commit changes
 		if not hold:
 			logger.debug("Commit changes!")
@@ -651,25 +1019,25 @@ class DatabaseFunctions(DatabaseConnection):
 		'''
 		if genomes: # check if genomes were specified for targeted deletion (sometimes a node can hold multiple genomes)
 			if not match_genome_only:
-				QUERY = "DELETE FROM {table} WHERE id in({nodes}) AND genome in({genomes})"
+				QUERY = "DELETE FROM {table} WHERE id IN (SELECT id FROM {nodes}) AND genome IN (SELECT value FROM {genomes})"
 			else:
-				QUERY = "DELETE FROM {table} WHERE genome in({genomes})"
+				QUERY = "DELETE FROM {table} WHERE genome IN (SELECT value FROM {genomes})"
 		else:
-			QUERY = "DELETE FROM {table} WHERE id in({nodes})"
+			QUERY = "DELETE FROM {table} WHERE id IN (SELECT id FROM {nodes})"
 
 		logger.info("Deleting {nnodes} annotations!".format(nnodes=len(nodes)))
 		#for node in nodes:
 			#logger.info("Delete genomes from: {node}".format(node=node))
 		if genomes:
 			if not match_genome_only:
-				logger.debug(QUERY.format(table=table,nodes="",genomes=""))
-				res = self.query(QUERY.format(table=table, nodes=",".join(list(map(str,nodes))), genomes='"'+'","'.join(list(map(str,genomes)))+'"'))
+				QUERY = QUERY.format(table=table, nodes=self.temp_ids(nodes), genomes=self.temp_values(genomes))
 			else:
-				res = self.query(QUERY.format(table=table, genomes='"'+'","'.join(list(map(str,genomes)))+'"'))
+				QUERY = QUERY.format(table=table, genomes=self.temp_values(genomes))
 		else:
-			logger.debug(QUERY.format(table=table,nodes=""))
-			res = self.query(QUERY.format(table=table, nodes=",".join(list(map(str,nodes)))))
-		
+			QUERY = QUERY.format(table=table, nodes=self.temp_ids(nodes))
+		logger.debug(QUERY)
+		res = self.query(QUERY)
+
 		## Commit changes
 		if not hold:
 			logger.debug("Commit changes!")
@@ -686,11 +1054,102 @@ class DatabaseFunctions(DatabaseConnection):
 		logger.debug(QUERY)
 		return self.query(QUERY.format(table=table)).fetchall()[0][0]
 
+	'''Change tracking functions of class'''
+	def track_changes(self):
+		'''Start logging changes to nodes, tree and rank in the change_log (used once a dump is written).
+			The triggers stay in the database and log every later insert, update and delete of these
+			tables, the log is pruned when a dump is recorded (see prune_changes), untrack_changes removes them
+
+		------
+		Returns
+			boolean
+		'''
+		if self.query("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'tree_insert_log'").fetchone() is None:
+			logger.info("Install change tracking in {database}, changes to nodes, tree and rank are logged so that unchanged dumps are skipped".format(database=self.database))
+		CreateDatabase().create_change_triggers(self.conn)
+		self.commit()
+		return True
+
+	def untrack_changes(self):
+		'''Remove the change tracking triggers and forget the recorded dumps (they can no longer be checked)
+
+		------
+		Returns
+			boolean
+		'''
+		schema = CreateDatabase()
+		schema.drop_change_triggers(self.conn)
+		schema.create_change_tracking(self.conn)
+		self.query("DELETE FROM change_log")
+		self.query("DELETE FROM dump_state")
+		self.commit()
+		return True
+
+	def prune_changes(self,seq):
+		'''Remove the logged changes up to seq, the sequence keeps counting so change_seq is not affected.
+			Only the change counts reported for older dumps (get_changes) are lost
+
+		------
+		Returns
+			int - number of rows removed
+		'''
+		removed = self.query("DELETE FROM change_log WHERE seq <= ?",insert_val=(int(seq),),error=True).rowcount
+		self.commit()
+		return removed
+
+	def change_seq(self):
+		'''Get the sequence number of the last logged change
+
+		------
+		Returns
+			int - last change_log seq (0 if nothing has been logged)
+		'''
+		if not self.table_exists("change_log"):
+			return 0
+		res = self.query("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+		return res[0] if res else 0
+
+	def get_changes(self,seq=0):
+		'''Count the nodes, links and ranks changed after a change_log seq
+
+		------
+		Returns
+			dict - table to number of changed rows
+		'''
+		QUERY = "SELECT tbl,count(DISTINCT id) FROM change_log WHERE seq > ? GROUP BY tbl"
+		logger.debug(QUERY)
+		return dict(self.query(QUERY,insert_val=(int(seq),),error=True).fetchall())
+
+	def get_dump_state(self,file):
+		'''Get the recorded state of a dump file
+
+		------
+		Returns
+			tuple - (settings, change_seq, md5) or None if the file has no recorded dump
+		'''
+		if not self.table_exists("dump_state"):
+			return None
+		QUERY = "SELECT settings,change_seq,md5 FROM dump_state WHERE file = ?"
+		return self.query(QUERY,insert_val=(file,),error=True).fetchone()
+
+	def set_dump_state(self,file,settings,seq,md5):
+		'''Record a written dump file
+
+		------
+		Returns
+			boolean
+		'''
+		QUERY = '''INSERT INTO dump_state(file,settings,change_seq,md5,dumped) VALUES (?,?,?,?,datetime('now'))
+					ON CONFLICT(file) DO UPDATE SET settings = excluded.settings, change_seq = excluded.change_seq, md5 = excluded.md5, dumped = excluded.dumped'''
+		self.cursor.execute(QUERY,(file,settings,int(seq),md5))
+		self.commit()
+		return True
+
 
 class ModifyFunctions(DatabaseFunctions):
 	"""ModifyFunctions adds nessesary functions when modifying a database"""
-	def __init__(self, database, verbose=False):
-		super().__init__(database, verbose)
+	def __init__(self, database, verbose=False, staging=False):
+		super().__init__(database, verbose, staging)
 		logger.debug("Load ModifyFunctions")
 
 	def get_rank(self,col=1):
@@ -710,33 +1169,14 @@ class ModifyFunctions(DatabaseFunctions):
 			rankDict[rank[1]] = rank[0]
 		return rankDict
 
-	def get_children(self,parents,children=set(),level=0,maxdepth=50,selected=False):
+	def get_children(self,parents,maxdepth=None,selected=False,rank=False):
 		'''Get all children from a parent
 
 		Returns
 		------
 			set - unique list of children from a decending tree
 		'''
-		if level >= maxdepth:
-			return children
-
-		QUERY = '''SELECT child FROM tree WHERE parent in({nodes})'''.format(nodes=",".join(map(str,list(parents))))
-
-		if selected:
-			QUERY = '''SELECT child FROM tree WHERE parent in({nodes}) and rank_i = {rank}'''.format(nodes=",".join(map(str,list(parents))), rank=selected)
-		#logger.debug(QUERY)
-		#print(QUERY)
-		res = self.query(QUERY).fetchall()
-		if (len(res) + len(children)) != 0:
-			children = set([child_i[0] for child_i in res])
-			if level < maxdepth:
-				try:
-					children |= self.get_children(parents=children,level=level+1,maxdepth=maxdepth)
-				except RecursionError:
-					logger.debug('Maximum depth reached, halting tree traversal')
-					return children
-
-		return children
+		return set(self.iter_subtree(parents,maxdepth=maxdepth,rank=rank,selected=selected))
 
 	def get_parent(self,name,all=False):
 		'''Get parent from node id parent
@@ -746,89 +1186,146 @@ class ModifyFunctions(DatabaseFunctions):
 			list - parent link and rank
 		'''
 		#QUERY = '''SELECT parent,child,rank FROM tree LEFT JOIN rank on (tree.rank_i = rank.rank_i) WHERE child = "{node}"'''.format(node=name)
-		QUERY = '''SELECT parent,child,rank_i FROM tree WHERE child = "{node}"'''.format(node=name)
+		QUERY = '''SELECT parent,child,rank_i FROM tree WHERE child = ?'''
 		logger.debug(QUERY)
 		if all:
-			res = self.query(QUERY).fetchall()
+			res = self.query(QUERY,insert_val=(name,),error=True).fetchall()
 		else:
-			res = self.query(QUERY).fetchone()
+			res = self.query(QUERY,insert_val=(name,),error=True).fetchone()
 		return res
 
-	def parse_parents(self,parents):
-		pret = set()
-		for pc in parents:
-			pret |= set([int(pc[0])])
-			pret |= set([int(pc[1])])
-		return pret
+	def iter_ancestors(self,nodes):
+		'''Stream the given nodes (if they are in the tree) and all their ancestors
+			using one recursive query, the node set is joined from a temp table
+
+		------
+		Returns
+			iterator - node ids, each node returned once
+		'''
+		held = self.conn.in_transaction
+		table = self.temp_ids(nodes,table="temp_lineage")
+		if self.closure:
+			QUERY = '''SELECT DISTINCT ancestor FROM tree_closure JOIN {table} ON tree_closure.descendant = {table}.id'''.format(table=table)
+		else:
+			QUERY = '''WITH RECURSIVE lineage(node) AS (
+						SELECT child FROM tree JOIN {table} ON tree.child = {table}.id
+						UNION
+						SELECT tree.parent FROM tree JOIN lineage ON tree.child = lineage.node
+					) SELECT node FROM lineage'''.format(table=table)
+		logger.debug(QUERY)
+		cursor = self.conn.cursor()
+		try:
+			for node in cursor.execute(QUERY):
+				yield node[0]
+		finally:
+			cursor.close()
+			self.end_read(held)
 
-	def get_parents(self,name,parents=set(),depth=0,find_all=False,simple=False,ncbi=False):
+	def get_parents(self,name,find_all=False,simple=False,ncbi=False):
 		'''Get all parents until root
 
+		Parameters
+			name     - node id or list of node ids (or links with the node id first)
+			find_all - include the given nodes in the result
+
 		Returns
 		------
-			list - all parents of a node
+			set - all parents of the nodes
 		'''
-		ld = depth+1
-		lmax = 12
-		if ncbi and depth == 0:
-			logger.info("NCBI mode on, minimum level to check 50 (since euk has red many levels) Will take time!")
-		lmax = 50
-		if simple:
-			simple=""
-		else:
-			simple=",rank_i"
-		try:
-			name = set(list(map(int,name))) ## Make sure all names are int
-		except TypeError:
-			name = set(list(map(int,[x[0] for x in name]))) ## Make sure all names are int
 		if isinstance(name, int):
 			name = [name]
-		if len(name & set([1])) > 0 and not ncbi:
-			#print(name)
-			return parents
-		QUERY = '''SELECT parent,child{simple} FROM tree WHERE child in ({node})'''.format(simple=simple, node=",".join(map(str,name)))
-		#if find_all: logger.info(QUERY)
-		res = self.query(QUERY).fetchall()
+		if ncbi:
+			logger.info("NCBI mode on, resolve all parents of {n} nodes".format(n=len(name)))
+		try:
+			nodes = set(map(int,name)) ## Make sure all names are int
+		except TypeError:
+			nodes = set(map(int,[x[0] for x in name]))
+		parents = set(self.iter_ancestors(nodes))
 		if not find_all:
-			try:
-				res = int(res[0])
-			except IndexError:
-				logger.warning("WARNING: parent could not be found for node {res} \n{query}".format(query=QUERY, res=name))
-				return set()
-			except TypeError:
-				#print(res)
-				logger.error("ERROR: cannot fetch parents when parents are duplicated!")
-				raise TreeError("cannot fetch parents when parents are duplicated!")
-			if res[0] == res[1]:  ## Special for root
-				return set([res[0]])
-			else:
-				## Add all parents
-				try:
-					#if ncbi:
-					#	logger.info("Loop depth: {ld}".format(ld=ld))
-					parents |= self.get_parents([int(res[0])],depth=ld,ncbi=ncbi)
-
-				except RecursionError:
-					print(res, name)
-			## Add current node
-			parents |= set([int(res[0])])
-		else:
-			parents = self.parse_parents(res) #set([(int(pc[0]),int(pc[-1])) for pc in res])
-			if len(parents-name) == 1 and ld > lmax:  ## There are no more parents to fetch
-				return parents
-			else:
-				## Add all parents
-				if ld > lmax:
-					return parents
-				try:
-					#if ncbi:
-					#	logger.info("Loop depth: {ld}".format(ld=ld))
-					parents |= self.get_parents(parents,find_all=find_all,depth=ld,ncbi=ncbi)
-				except RecursionError:
-					logger.info("RecursionError, node requested")
-					print(res, name)
+			parents -= nodes
 		return parents
 
+	def get_lineages(self,nodes):
+		'''Resolve the full lineage of a batch of nodes in one pass, the parent links of all
+			ancestors are fetched with one query and the lineages built from that parent array.
+			A node with more than one parent follows its first link (tree rowid order), the closure
+			table (if built) is only used to find the ancestors
+
+		Returns
+		------
+			dict - node id to tuple of ids (node, parent, ..., root) for all nodes found in the tree
+		'''
+		nodes = set(map(int,nodes))
+		held = self.conn.in_transaction
+		table = self.temp_ids(nodes,table="temp_lineage")
+		if self.closure:
+			ancestors = '''SELECT DISTINCT ancestor AS node FROM tree_closure JOIN {table} ON tree_closure.descendant = {table}.id
+						WHERE EXISTS (SELECT 1 FROM tree WHERE tree.child = {table}.id)'''.format(table=table)
+			QUERY = '''SELECT lineage.node,tree.parent FROM ({ancestors}) lineage'''.format(ancestors=ancestors)
+		else:
+			QUERY = '''WITH RECURSIVE lineage(node) AS (
+						SELECT child FROM tree JOIN {table} ON tree.child = {table}.id
+						UNION
+						SELECT tree.parent FROM tree JOIN lineage ON tree.child = lineage.node
+					) SELECT lineage.node,tree.parent FROM lineage'''.format(table=table)
+		QUERY += '''
+					LEFT JOIN tree ON tree.child = lineage.node AND tree.child != tree.parent ORDER BY tree.rowid'''
+		logger.debug(QUERY)
+		parent = {}
+		try:
+			for node,parent_i in self.query(QUERY):
+				if node in parent and parent_i != parent[node]:
+					logger.debug("Node {node} has more than one parent, lineage follows {parent}".format(node=node,parent=parent[node]))
+					continue
+				parent[node] = parent_i
+		finally:
+			self.end_read(held)
+		lineages = {}
+		for node in nodes:
+			if node not in parent:
+				continue
+			path = []
+			current = node
+			while current is not None and current not in lineages:
+				if current in path:
+					raise TreeError("Cycle detected in the lineage of node {node}".format(node=node))
+				path.append(current)
+				current = parent[current]
+			lineage = lineages[current] if current is not None else ()
+			for current in reversed(path):
+				lineage = (current,) + lineage
+				lineages[current] = lineage
+		return {node: lineages[node] for node in nodes if node in lineages}
+
+	def get_lca(self,nodes):
+		'''Get the lowest common ancestor of a set of nodes
+
+		Returns
+		------
+			int - node id of the lowest common ancestor (False if the nodes do not share an ancestor)
+		'''
+		nodes = set(map(int,nodes))
+		lineages = list(self.get_lineages(nodes).values())
+		if len(lineages) != len(nodes) or len(lineages) == 0:
+			return False
+		shared = set(lineages[0]).intersection(*lineages[1:])
+		for node in lineages[0]:
+			if node in shared:
+				return node
+		return False
+
+	def is_descendant(self,node,ancestor):
+		'''Check if a node is placed under ancestor in the tree
+
+		Returns
+		------
+			boolean
+		'''
+		if self.closure:
+			QUERY = "SELECT 1 FROM tree_closure WHERE ancestor = ? AND descendant = ? AND depth > 0"
+			return self.query(QUERY,insert_val=(int(ancestor),int(node)),error=True).fetchone() is not None
+		return int(ancestor) in self.get_parents(node)
+
 	def get_id(self,name):
 		'''get node id from name
 
@@ -836,9 +1333,9 @@ class ModifyFunctions(DatabaseFunctions):
 		------
 			int - node id from node name
 		'''
-		QUERY = '''SELECT id FROM nodes WHERE name = "{node}" COLLATE NOCASE'''.format(node=name)
+		QUERY = '''SELECT id FROM nodes WHERE name = ? COLLATE NOCASE'''
 		try:
-			res = self.query(QUERY).fetchone()[0]
+			res = self.query(QUERY,insert_val=(name,),error=True).fetchone()[0]
 		except TypeError:
 			logger.debug(QUERY)
 			raise NameError("Name not found in the database! {name}".format(name=name))
@@ -0,0 +1,557 @@
+'''
+In memory index of the tree table
+
+The tree is loaded once into compact arrays (one slot per node) so that parent lookups,
+subtree and lineage walks and lowest common ancestor queries can be answered without
+re-querying the database. All arrays are stdlib arrays of C ints, a full NCBI taxonomy
+(~2.5 million nodes) needs about 100 MB.
+
+	ids          - node id per row (sorted)
+	parents      - row of the parent per row (-1 for roots)
+	ranks        - rank_i of the link to the parent
+	offsets      - CSR offsets into children, children of row r are children[offsets[r]:offsets[r+1]]
+	children     - rows of the children of all nodes
+	depths       - depth of each row below its root (-1 if not reachable from a root)
+	euler        - euler tour over the primary parent links, used for the LCA
+
+Nodes with more than one parent keep the first link as their parent, the other links
+are kept in extra_links and are followed when walking subtrees. The walk function is the
+shared traversal used to validate and clean the tree, it finds cycles and reports the depth
+histogram of the nodes it visits.
+'''
+
+from array import array
+from bisect import bisect_left
+import logging
+logger = logging.getLogger(__name__)
+
+class TreeReport(object):
+	"""Result of TreeIndex.validate, the report is true when the tree is valid"""
+	def __init__(self):
+		self.nodes = 0				## Annotated nodes (nodes table)
+		self.links = 0				## Links in the tree table
+		self.tree_nodes = 0			## Nodes under root
+		self.tree_links = 0			## Links touching a node under root
+		self.link_nodes = 0			## Nodes used in links
+		self.multi_parents = []		## Nodes with more than one parent
+		self.rank_conflicts = []	## Nodes with more than one parent where two of the links have the same rank
+		self.orphans = []			## Nodes not under root (and not in a cycle)
+		self.cycles = []			## Cycles in the parent links, each a list of node ids
+		self.unannotated = []		## Nodes in links without a description in the nodes table
+		self.detached_links = 0		## Links with no node under root
+		self.depths = []			## Number of nodes under root per depth
+
+	def __bool__(self):
+		return not (self.rank_conflicts or self.orphans or self.cycles or self.unannotated or self.detached_links)
+
+	def __str__(self):
+		return """Tree statistics
+					Nodes: {nodes}
+					Links: {links}
+					Tree: n({tnodes}), l({tlinks})
+					LinkNodes: {link_nodes}
+					Multiple parents: {multi}
+					Orphans: {orphans}
+					Cycles: {cycles}
+					Unannotated: {unannotated}
+					Depth: {depth}
+					""".format(depth=len(self.depths)-1,nodes=self.nodes,links=self.links,tnodes=self.tree_nodes,tlinks=self.tree_links,link_nodes=self.link_nodes,
+						multi=len(self.multi_parents),orphans=len(self.orphans),cycles=len(self.cycles),unannotated=len(self.unannotated))
+
+class TreeWalk(object):
+	"""Result of TreeIndex.walk, the nodes visited, the depth histogram and the cycles found"""
+	def __init__(self,index):
+		self.index = index
+		self.visited = bytearray(index.size)
+		self.histogram = []		## Number of nodes visited per depth
+		self.cycles = []		## Cycles found, each a list of node ids
+		self.truncated = 0		## Links not followed because maxdepth was reached
+
+	def __len__(self):
+		return self.visited.count(1)
+
+	def __contains__(self,node):
+		row = self.index.row(node)
+		return row >= 0 and self.visited[row] == 1
+
+	def nodes(self):
+		'''Get the visited node ids
+
+		------
+		Returns
+			set - node ids
+		'''
+		ids,visited = self.index.ids,self.visited
+		return set(ids[row] for row in range(len(visited)) if visited[row])
+
+class TreeIndex(object):
+	"""Compact in memory representation of the tree table"""
+	BLOCK = 64		## Block size of the euler tour range minimum query
+
+	def __init__(self, ids, links, annotated=False):
+		'''Build the index
+
+		Parameters
+			ids       - sorted iterable of all node ids in the tree (nodes and link ends)
+			links     - callable returning a fresh iterator of (parent,child,rank_i) links, it is consumed twice
+			annotated - iterable of node ids with a description in the nodes table
+		'''
+		self.ids = array("i",ids)
+		self.size = len(self.ids)
+		self._build_map()
+		self.annotated = bytearray(self.size)
+		if annotated:
+			for node in annotated:
+				row = self.row(node)
+				if row >= 0:
+					self.annotated[row] = 1
+		self._build_links(links)
+		self._build_euler()
+		logger.debug("Tree index of {n} nodes uses {mb:.1f} MB".format(n=self.size,mb=self.nbytes()/1048576))
+
+	@classmethod
+	def from_database(cls,database):
+		'''Load the tree from a database connection (DatabaseFunctions)
+
+		------
+		Returns
+			TreeIndex
+		'''
+		logger.info("Load tree index")
+		QUERY = '''SELECT id FROM nodes UNION SELECT parent FROM tree UNION SELECT child FROM tree ORDER BY 1'''
+		logger.debug(QUERY)
+		ids = (row[0] for row in database.query(QUERY,cursor=database.conn.cursor()) if row[0] is not None)
+		annotated = (row[0] for row in database.query("SELECT id FROM nodes",cursor=database.conn.cursor()))
+		return cls(ids,lambda: database.query("SELECT parent,child,rank_i FROM tree",cursor=database.conn.cursor()),annotated=annotated)
+
+	'''Build functions of class'''
+	def _build_map(self):
+		'''Map node ids to rows, a dense array when ids are compact otherwise a binary search in ids'''
+		self.dense = False
+		if self.size and self.ids[-1] < 2*self.size + 1024:
+			self.dense = array("i",[-1])*(self.ids[-1]+1)
+			for row,node in enumerate(self.ids):
+				self.dense[node] = row
+
+	def _build_links(self,links):
+		'''Set the parent of each row and build the CSR child lists from all links'''
+		self.parents = array("i",[-1])*self.size
+		self.ranks = array("H",[0])*self.size		## rank_i values are small, widened if needed
+		counts = array("i",[0])*(self.size+1)
+		self.self_links = []
+		self.extra_links = []
+		self.extra_parents = {}
+		row = self.dense.__getitem__ if self.dense is not False else self.row  ## Every link end is in ids
+		parents = self.parents
+		for parent,child,rank in links():
+			child_row,parent_row = row(child),row(parent)
+			rank = rank or 0
+			if rank > 65535 and self.ranks.typecode == "H":
+				self.ranks = array("i",self.ranks)
+			if child_row == parent_row:
+				self.self_links.append(child)			## The root is linked to itself
+				self.ranks[child_row] = rank
+				continue
+			if parents[child_row] == -1:
+				parents[child_row] = parent_row
+				self.ranks[child_row] = rank
+			else:
+				self.extra_links.append((parent,child,rank))
+				self.extra_parents.setdefault(child_row,[]).append(parent_row)
+			counts[parent_row+1] += 1
+		for i in range(self.size):
+			counts[i+1] += counts[i]
+		self.offsets = counts
+		self.children = array("i",[0])*self.offsets[-1]
+		fill = array("i",self.offsets[:-1])
+		children = self.children
+		for parent,child,rank in links():
+			if parent == child:
+				continue
+			parent_row = row(parent)
+			children[fill[parent_row]] = row(child)
+			fill[parent_row] += 1
+
+	def _build_euler(self):
+		'''Walk the primary parent links from every root and record the euler tour, depth and first visit of each row'''
+		self.depths = array("i",[-1])*self.size
+		self.first = array("i",[-1])*self.size
+		self.euler = array("i")
+		parents,offsets,children,depths,first,euler = self.parents,self.offsets,self.children,self.depths,self.first,self.euler
+		for root in (row for row in range(self.size) if parents[row] == -1):
+			depths[root] = 0
+			first[root] = len(euler)
+			euler.append(root)
+			stack = [root]
+			positions = [offsets[root]]
+			while stack:
+				node = stack[-1]
+				i,end = positions[-1],offsets[node+1]
+				while i < end and parents[children[i]] != node:  ## Links to nodes with another parent are not part of the tour
+					i += 1
+				if i < end:
+					positions[-1] = i+1
+					child = children[i]
+					depths[child] = depths[node]+1
+					first[child] = len(euler)
+					euler.append(child)
+					stack.append(child)
+					positions.append(offsets[child])
+				else:
+					stack.pop()
+					positions.pop()
+					if stack:
+						euler.append(stack[-1])
+		self._build_rmq()
+
+	def _build_rmq(self):
+		'''Sparse table of the shallowest row in each run of 2^k euler blocks'''
+		key = self.depths.__getitem__
+		blocks = array("i",(min(self.euler[i:i+self.BLOCK],key=key) for i in range(0,len(self.euler),self.BLOCK)))
+		self.sparse = [blocks]
+		span = 1
+		while 2*span <= len(blocks):
+			previous = self.sparse[-1]
+			self.sparse.append(array("i",(min(previous[i],previous[i+span],key=key) for i in range(len(previous)-span))))
+			span *= 2
+
+	def _range_min(self,start,end):
+		'''Return the shallowest row in euler[start:end+1]'''
+		key = self.depths.__getitem__
+		first_block,last_block = start//self.BLOCK + 1, end//self.BLOCK
+		if first_block >= last_block:
+			return min(self.euler[start:end+1],key=key)
+		candidates = [min(self.euler[start:first_block*self.BLOCK],key=key),min(self.euler[last_block*self.BLOCK:end+1],key=key)]
+		level = (last_block - first_block).bit_length() - 1
+		table = self.sparse[level]
+		candidates += [table[first_block],table[last_block - (1 << level)]]
+		return min(candidates,key=key)
+
+	'''Lookup functions of class'''
+	def row(self,node):
+		'''Get the row of a node id
+
+		------
+		Returns
+			int - row of the node, -1 if the node is not in the tree
+		'''
+		if self.dense is not False:
+			if 0 <= node < len(self.dense):
+				return self.dense[node]
+			return -1
+		row = bisect_left(self.ids,node)
+		if row < self.size and self.ids[row] == node:
+			return row
+		return -1
+
+	def __len__(self):
+		return self.size
+
+	def __contains__(self,node):
+		return self.row(node) >= 0
+
+	def nbytes(self):
+		'''Memory used by the index arrays in bytes'''
+		arrays = [self.ids,self.parents,self.ranks,self.offsets,self.children,self.depths,self.first,self.euler] + self.sparse
+		if self.dense is not False:
+			arrays.append(self.dense)
+		return sum(len(a)*a.itemsize for a in arrays) + len(self.annotated)
+
+	def parent(self,node):
+		'''Get the parent of a node
+
+		------
+		Returns
+			int - parent id, None for roots and nodes not in the tree
+		'''
+		row = self.row(node)
+		if row < 0 or self.parents[row] < 0:
+			return None
+		return self.ids[self.parents[row]]
+
+	def rank(self,node):
+		'''Get the rank_i of the link from a node to its parent'''
+		row = self.row(node)
+		return self.ranks[row] if row >= 0 else None
+
+	def depth(self,node):
+		'''Get the depth of a node below its root (-1 if the node is not under a root)'''
+		row = self.row(node)
+		return self.depths[row] if row >= 0 else -1
+
+	def get_children(self,node):
+		'''Get the direct children of a node (through all links)
+
+		------
+		Returns
+			list - child ids
+		'''
+		row = self.row(node)
+		if row < 0:
+			return []
+		return [self.ids[child] for child in self.children[self.offsets[row]:self.offsets[row+1]]]
+
+	def iter_subtree(self,parents,maxdepth=None):
+		'''Stream all descendants of the given parents (breadth first), follows every link so
+			nodes with more than one parent are found under all their parents
+
+		Parameters
+			parents  - iterable of node ids to start from
+			maxdepth - number of levels to descend (None walks the whole subtree)
+
+		------
+		Returns
+			iterator - node ids of the descendants, each node returned once
+		'''
+		if maxdepth is not None and maxdepth < 1:
+			return
+		offsets,children,ids = self.offsets,self.children,self.ids
+		seen = bytearray(self.size)
+		level = [row for row in map(self.row,parents) if row >= 0]
+		looped = set(self.self_links)
+		for row in level:
+			if self.ids[row] in looped and not seen[row]:  ## Nodes linked to themselves (root) are part of their own subtree
+				seen[row] = 1
+				yield self.ids[row]
+		depth = 0
+		while level and (maxdepth is None or depth < maxdepth):
+			depth += 1
+			next_level = []
+			for row in level:
+				for child in children[offsets[row]:offsets[row+1]]:
+					if not seen[child]:
+						seen[child] = 1
+						next_level.append(child)
+						yield ids[child]
+			level = next_level
+
+	def iter_ancestors(self,node):
+		'''Stream the parents of a node up to its root
+
+		------
+		Returns
+			iterator - ancestor ids, closest parent first
+		'''
+		row = self.row(node)
+		if row < 0:
+			return
+		parents,ids = self.parents,self.ids
+		row = parents[row]
+		steps = 0
+		while row >= 0 and steps < self.size:  ## A cycle never reaches a root, stop after visiting every row once
+			yield ids[row]
+			row = parents[row]
+			steps += 1
+
+	def lineage(self,node):
+		'''Get the lineage of a node
+
+		------
+		Returns
+			tuple - (node, parent, ..., root), empty if the node is not in the tree
+		'''
+		if node not in self:
+			return ()
+		return (node,) + tuple(self.iter_ancestors(node))
+
+	def get_lca(self,nodes):
+		'''Get the lowest common ancestor of a set of nodes from the euler tour
+
+		------
+		Returns
+			int - node id of the lowest common ancestor (False if the nodes do not share an ancestor)
+		'''
+		rows = [self.row(node) for node in set(nodes)]
+		if len(rows) == 0 or min(rows) < 0:
+			return False
+		positions = [self.first[row] for row in rows]
+		if min(positions) < 0:
+			return False
+		lca = self._range_min(min(positions),max(positions))
+		if self.depths[lca] == 0 and any(self._root(row) != lca for row in rows):
+			return False	## The nodes are in separate trees
+		return self.ids[lca]
+
+	def _root(self,row):
+		'''Get the root row above a row'''
+		while self.parents[row] >= 0:
+			row = self.parents[row]
+		return row
+
+	'''Traversal functions of class'''
+	def _parent_rows(self,row):
+		'''All parent rows of a row'''
+		if self.parents[row] < 0:
+			return ()
+		return [self.parents[row]] + self.extra_parents.get(row,[])
+
+	def _child_rows(self,row):
+		'''All child rows of a row'''
+		return self.children[self.offsets[row]:self.offsets[row+1]]
+
+	def walk(self,nodes,maxdepth=None,up=False,result=None):
+		'''Iterative depth first walk along all links from the given nodes (the nodes are visited as well).
+			The current path is kept on an explicit stack, there is no recursion limit, and a link back
+			to a node on the path is recorded as a cycle and not followed. A walk limited by maxdepth
+			is breadth first instead (see _walk_levels) and does not report cycles
+
+		Parameters
+			nodes    - iterable of node ids to start from
+			maxdepth - number of levels to walk (None walks everything)
+			up       - walk the parent links instead of the child links
+			result   - TreeWalk to continue, nodes visited by it are not visited again
+
+		------
+		Returns
+			TreeWalk
+		'''
+		if result is None:
+			result = TreeWalk(self)
+		next_rows = self._parent_rows if up else self._child_rows
+		if maxdepth is not None:
+			return self._walk_levels(nodes,maxdepth,next_rows,result)
+		visited,histogram,ids = result.visited,result.histogram,self.ids
+		on_path = bytearray(self.size)
+		for start in map(self.row,nodes):
+			if start < 0 or visited[start]:
+				continue
+			visited[start] = on_path[start] = 1
+			if not histogram:
+				histogram.append(0)
+			histogram[0] += 1
+			path = [start]
+			branches = [iter(next_rows(start))]
+			while path:
+				for row in branches[-1]:
+					if on_path[row]:
+						result.cycles.append([ids[r] for r in path[path.index(row):]])
+					elif not visited[row]:
+						depth = len(path)
+						visited[row] = on_path[row] = 1
+						if depth == len(histogram):
+							histogram.append(0)
+						histogram[depth] += 1
+						path.append(row)
+						branches.append(iter(next_rows(row)))
+						break
+				else:
+					on_path[path.pop()] = 0
+					branches.pop()
+		return result
+
+	def _walk_levels(self,nodes,maxdepth,next_rows,result):
+		'''Breadth first walk of at most maxdepth levels, every node is reached at its shortest depth
+			(a depth first walk may reach a node with several parents through a longer path first and
+			would then not expand it at the shorter depth)
+
+		------
+		Returns
+			TreeWalk
+		'''
+		visited,histogram = result.visited,result.histogram
+		level = []
+		for start in map(self.row,nodes):
+			if start >= 0 and not visited[start]:
+				visited[start] = 1
+				level.append(start)
+		depth = 0
+		while level:
+			if depth == len(histogram):
+				histogram.append(0)
+			histogram[depth] += len(level)
+			if depth == maxdepth:
+				result.truncated += sum(1 for row in level for next_row in next_rows(row) if not visited[next_row])
+				break
+			next_level = []
+			for row in level:
+				for next_row in next_rows(row):
+					if not visited[next_row]:
+						visited[next_row] = 1
+						next_level.append(next_row)
+			level = next_level
+			depth += 1
+		return result
+
+	def linked(self,node):
+		'''Check if a node is the child in a link (including a link to itself)'''
+		row = self.row(node)
+		return row >= 0 and (self.parents[row] >= 0 or node in self.self_links)
+
+	'''Validate functions of class'''
+	def validate(self,root=1):
+		'''Validate the tree in linear time over the index arrays
+			1. Nodes with more than one parent, placing a node twice at the same rank is an error
+			2. Nodes and links not attached under root (orphans)
+			3. Cycles in the parent links
+			4. Nodes in links without a node description (unannotated)
+
+		------
+		Returns
+			TreeReport
+		'''
+		report = TreeReport()
+		offsets,children,ids,size = self.offsets,self.children,self.ids,self.size
+		## Nodes under root, following all links like iter_subtree
+		tree = self.walk([root])
+		under = bytearray(tree.visited)
+		report.depths = list(tree.histogram)
+		if root in self and root not in self.self_links:  ## root is only part of its own subtree when linked to itself
+			under[self.row(root)] = 0
+		## Continue the walk from all remaining nodes to find the cycles outside root
+		self.walk((ids[row] for row in range(size) if not tree.visited[row]),result=tree)
+		report.cycles = tree.cycles
+		in_cycle = bytearray(size)
+		for cycle in report.cycles:
+			for node in cycle:
+				in_cycle[self.row(node)] = 1
+		## One pass over all rows and their links
+		link_node = bytearray(size)
+		for node in self.self_links:
+			link_node[self.row(node)] = 1
+		has_parent = bytearray(size)
+		for row in range(size):
+			start,end = offsets[row],offsets[row+1]
+			if start == end:
+				continue
+			link_node[row] = 1
+			for child in children[start:end]:
+				link_node[child] = 1
+				if under[row] or under[child]:
+					report.tree_links += 1
+				else:
+					report.detached_links += 1
+				if has_parent[child]:
+					report.multi_parents.append(ids[child])
+				has_parent[child] = 1
+		report.links = offsets[-1] + len(self.self_links)
+		report.tree_links += sum(1 for node in self.self_links if under[self.row(node)])
+		report.detached_links += sum(1 for node in self.self_links if not under[self.row(node)])
+		report.multi_parents = sorted(set(report.multi_parents))
+		link_ranks = {}
+		for parent,child,rank in self.extra_links:
+			row = self.row(child)
+			ranks = link_ranks.setdefault(row,{self.ranks[row]})
+			if rank in ranks:
+				report.rank_conflicts.append(child)
+			ranks.add(rank)
+		report.rank_conflicts = sorted(set(report.rank_conflicts))
+		report.nodes = self.annotated.count(1)
+		report.tree_nodes = under.count(1)
+		report.link_nodes = link_node.count(1)
+		for row in range(size):
+			if not under[row] and not in_cycle[row]:
+				report.orphans.append(ids[row])
+			if link_node[row] and not self.annotated[row]:
+				report.unannotated.append(ids[row])
+		return report
+
+	def is_descendant(self,node,ancestor):
+		'''Check if a node is placed under ancestor (through the primary parent links)
+
+		------
+		Returns
+			boolean
+		'''
+		if node == ancestor:
+			return False
+		return self.get_lca([node,ancestor]) == ancestor
@@ -2,6 +2,10 @@ from subprocess import check_call,CalledProcessError,TimeoutExpired,STDOUT
 from subprocess import Popen,STDOUT,PIPE,CalledProcessError,TimeoutExpired
 from textwrap import wrap
 from os import makedirs,path,walk
+from contextlib import contextmanager
+from shutil import which
+import gzip
+import zlib
 import glob
 import logging
 from time import sleep
@@ -150,6 +154,51 @@ def download_genomes(genomes,added,filepath,missing,force=False):
 					print("missing")
 					missing.put(genome["accession"].strip())
 
+def gzip_opener():
+	'''Return the open function of the fastest available gzip implementation (python-isal or zlib-ng)
+
+		Returns
+			function or False if none of them is installed
+	'''
+	try:
+		from isal import igzip
+		return igzip.open
+	except ImportError:
+		pass
+	try:
+		from zlib_ng import gzip_ng
+		return gzip_ng.open
+	except ImportError:
+		pass
+	return False
+
+@contextmanager
+def open_gzip(filepath):
+	'''Open a gzip compressed file for binary reading, use python-isal or zlib-ng if installed,
+		otherwise decompress through pigz if available and fall back on the gzip module
+		Parameters
+			str - filepath
+		------
+		Returns
+			file object - decompressed binary stream
+	'''
+	opener = gzip_opener()
+	if opener:
+		with opener(filepath, "rb") as f:
+			yield f
+	elif which("pigz"):
+		proc = Popen(["pigz","-dc",filepath],stdout=PIPE)
+		try:
+			yield proc.stdout
+		finally:
+			proc.stdout.close()
+			returncode = proc.wait()
+		if returncode > 0:
+			raise zlib.error("pigz could not decompress {file} (exit status {code})".format(file=filepath,code=returncode))
+	else:
+		with gzip.open(filepath, "rb") as f:
+			yield f
+
 def read_file(fin):
 	'''Read a one column file (or at least use only first column) and return list
 		Parameters
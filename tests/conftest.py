@@ -0,0 +1,24 @@
+import pytest
+
+from flextaxd.modules.database.DatabaseConnection import ModifyFunctions
+
+## Multi-parent test tree, node 3 is linked from 2 (first) and from the root
+LINKS = [(1,1),(1,2),(2,3),(1,3),(3,4)]
+
+def build_database(path, links=LINKS, ranks={}):
+	'''Create a database with nodes n1..nN and the given (parent,child) links, ranks maps
+		a link (or the child of a link) to its rank name (default "no rank")'''
+	db = ModifyFunctions(str(path))
+	for rank in ["no rank"] + sorted(set(ranks.values())):
+		db.add_rank(rank)
+	rank_ids = db.get_rank(col=0)
+	nodes = sorted(set(node for link in links for node in link))
+	db.add_nodes([(node,"n{}".format(node)) for node in nodes])
+	db.load_links([(parent,child,rank_ids[ranks.get((parent,child),ranks.get(child,"no rank"))]) for parent,child in links])
+	return db
+
+@pytest.fixture
+def tree_db(tmp_path):
+	db = build_database(tmp_path / "tree.db")
+	yield db
+	db.conn.close()
@@ -0,0 +1,30 @@
+import pytest
+
+from conftest import build_database
+from flextaxd.modules.BinaryTaxonomy import BinaryTaxonomy, FormatError, write_binary
+from flextaxd.modules.WriteTaxonomy import WriteTaxonomy
+
+def test_write_binary_round_trip(tmp_path):
+	path = str(tmp_path / "taxonomy.ftb")
+	names = ["root","Bacteria","Escherichia coli","Å unicode name",""]
+	assert write_binary(path,[1,2,5,7,9],[1,1,2,5,-1],[1,2,3,3,1],iter(names),[(1,"no rank"),(2,"superkingdom"),(3,"species")]) == 5
+	with BinaryTaxonomy(path) as taxonomy:
+		assert len(taxonomy) == 5
+		assert list(taxonomy.ids) == [1,2,5,7,9]
+		assert [taxonomy.name(node) for node in taxonomy.ids] == names
+		assert taxonomy.parent(1) == 1 and taxonomy.parent(9) is None
+		assert taxonomy.rank(5) == "species" and taxonomy.rank(2) == "superkingdom"
+		assert taxonomy.lineage(7) == [7,5,2,1]
+		assert 3 not in taxonomy and taxonomy.name(3) is None
+
+def test_write_binary_requires_a_name_per_node(tmp_path):
+	with pytest.raises(FormatError):
+		write_binary(str(tmp_path / "taxonomy.ftb"),[1,2],[1,1],[1,1],iter(["root"]),[(1,"no rank")])
+
+def test_dump_binary_matches_database(tmp_path):
+	db = build_database(tmp_path / "tree.db",ranks={2:"genus",(2,3):"species",(1,3):"genus",4:"strain"})
+	assert WriteTaxonomy(str(tmp_path),database=db.database).dump_binary() == 4
+	with BinaryTaxonomy(str(tmp_path / "taxonomy.ftb")) as taxonomy:
+		assert [taxonomy.name(node) for node in (1,2,3,4)] == ["n1","n2","n3","n4"]
+		assert [taxonomy.rank(node) for node in (2,3,4)] == ["genus","species","strain"]
+		assert taxonomy.lineage(4) == list(db.get_lineages([4])[4])
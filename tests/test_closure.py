@@ -0,0 +1,81 @@
+from conftest import LINKS
+
+def queries(db):
+	'''Ancestry query results that must not depend on the closure table'''
+	return {
+		"lineages": db.get_lineages([1,2,3,4]),
+		"lca": [db.get_lca(nodes) for nodes in ([4,2],[3,2],[4])],
+		"subtree": [db.get_children([1],maxdepth=depth) for depth in (0,1,2,3,None)],
+		"subtree_2": db.get_children([2]),
+		"parents": db.get_parents(4),
+		"descendant": [db.is_descendant(4,2),db.is_descendant(2,3)],
+	}
+
+def test_lineage_follows_one_parent_path(tree_db):
+	lineages = tree_db.get_lineages([4])
+	assert lineages[4] == (4,3,2,1)
+
+def test_queries_match_with_closure_table(tree_db):
+	expected = queries(tree_db)
+	assert expected["subtree"][0] == set()
+	assert expected["subtree"][2] == {1,2,3,4}
+	tree_db.build_closure()
+	assert queries(tree_db) == expected
+
+def test_closure_keeps_shortest_depth(tree_db):
+	tree_db.build_closure()
+	QUERY = "SELECT depth FROM tree_closure WHERE ancestor = 1 AND descendant = 4"
+	assert tree_db.query(QUERY).fetchone()[0] == 2
+	tree_db.add_links([(1,4,1)])
+	assert tree_db.query(QUERY).fetchone()[0] == 1
+	assert tree_db.get_children([1],maxdepth=1) == {1,2,3,4}
+
+def test_closure_follows_deleted_links(tree_db):
+	tree_db.build_closure()
+	tree_db.delete_links([(1,3,1),(3,4,1)])
+	with_closure = queries(tree_db)
+	tree_db.closure = False
+	assert queries(tree_db) == with_closure
+	rows = set(tree_db.query("SELECT ancestor,descendant,depth FROM tree_closure WHERE depth > 0").fetchall())
+	assert rows == {(1,2,1),(1,3,2),(2,3,1)}
+
+def test_delete_links_hold_does_not_commit(tree_db):
+	tree_db.build_closure()
+	closure = tree_db.num_rows("tree_closure")
+	tree_db.fast_delete_links([(2,3,1)],hold=True)
+	tree_db.ambigious_delete_links([3,4],hold=True)
+	tree_db.conn.rollback()
+	assert tree_db.num_rows("tree") == len(LINKS)
+	assert tree_db.num_rows("tree_closure") == closure
+
+def test_reads_release_the_database(tree_db):
+	import sqlite3
+	for closure in (False,True):
+		if closure:
+			tree_db.build_closure()
+		tree_db.get_lineages([4])
+		tree_db.get_parents(4)
+		assert not tree_db.conn.in_transaction
+		writer = sqlite3.connect(tree_db.database,timeout=0)
+		writer.execute("INSERT INTO nodes(name) VALUES ('writer')")
+		writer.commit()
+		writer.close()
+
+def test_reads_keep_a_held_transaction(tree_db):
+	tree_db.delete_links([(3,4,1)],hold=True)
+	tree_db.get_lineages([4])
+	assert tree_db.conn.in_transaction
+	tree_db.conn.rollback()
+	assert tree_db.num_rows("tree") == len(LINKS)
+
+def test_closure_follows_loaded_links(tree_db):
+	tree_db.build_closure()
+	tree_db.add_nodes([(5,"n5"),(6,"n6")])
+	tree_db.load_links([(4,5,1)])
+	tree_db.add_link(child=6,parent=5)
+	assert set(tree_db.iter_subtree([3])) == {4,5,6}
+	assert tree_db.is_descendant(5,1)
+	assert tree_db.is_descendant(6,2)
+	with_closure = queries(tree_db)
+	tree_db.closure = False
+	assert queries(tree_db) == with_closure
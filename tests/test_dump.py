@@ -0,0 +1,48 @@
+import os
+
+from flextaxd.modules.WriteTaxonomy import WriteTaxonomy
+
+def triggers(db):
+	return db.query("SELECT count(*) FROM sqlite_master WHERE type = 'trigger'").fetchone()[0]
+
+def test_dump_prunes_change_log(tree_db, tmp_path):
+	writer = WriteTaxonomy(str(tmp_path), database=tree_db.database)
+	assert writer.dump() is True
+	assert writer.dump() is False
+	tree_db.add_nodes([(5,"n5")])
+	tree_db.add_links([(4,5,1)])
+	assert tree_db.num_rows("change_log") == 2
+	assert writer.dump() is True
+	assert tree_db.num_rows("change_log") == 0
+	assert writer.dump() is False
+
+def test_untracked_dump_removes_triggers(tree_db, tmp_path):
+	WriteTaxonomy(str(tmp_path), database=tree_db.database).dump()
+	assert triggers(tree_db) > 0
+	writer = WriteTaxonomy(str(tmp_path), database=tree_db.database, track_changes=False)
+	assert writer.dump() is True
+	assert writer.dump() is True
+	assert triggers(tree_db) == 0
+	assert tree_db.num_rows("dump_state") == 0
+
+def test_untracked_dumps_do_not_lock_the_database(tree_db, tmp_path):
+	first = WriteTaxonomy(str(tmp_path), database=tree_db.database, track_changes=False)
+	assert first.dump() is True
+	assert first.remap
+	assert not first.database.conn.in_transaction
+	second = WriteTaxonomy(str(tmp_path), database=tree_db.database, track_changes=False)
+	assert second.dump() is True
+	assert not second.database.conn.in_transaction
+
+def test_parallel_compressed_genomes_match(tree_db, tmp_path):
+	import gzip
+	tree_db.add_genomes([("GCF_{}".format(i),i % 4 + 1,i % 3) for i in range(50)])
+	plain = WriteTaxonomy(str(tmp_path / "plain"), database=tree_db.database)
+	os.makedirs(plain.path)
+	plain.dump_genomes()
+	packed = WriteTaxonomy(str(tmp_path / "packed"), database=tree_db.database, compress=True)
+	packed.batch_size = 7
+	os.makedirs(packed.path)
+	packed.dump_genomes(workers=2)
+	with open(plain.output_file("genomes"),"rb") as expected, gzip.open(packed.output_file("genomes"),"rb") as written:
+		assert written.read() == expected.read()
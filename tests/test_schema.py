@@ -0,0 +1,17 @@
+from flextaxd.modules.database.CreateDatabase import CreateDatabase
+from flextaxd.modules.database.DatabaseConnection import DatabaseFunctions
+
+def test_missing_indexes_are_recreated_on_connect(tree_db):
+	schema = CreateDatabase()
+	assert schema.missing_indexes(tree_db.conn) == []
+	tree_db.query("DROP INDEX nodes_name_index")
+	tree_db.query("DROP INDEX tree_child_index")
+	tree_db.commit()
+	assert len(schema.missing_indexes(tree_db.conn)) == 2
+	db = DatabaseFunctions(tree_db.database)
+	assert schema.missing_indexes(db.conn) == []
+
+def test_fast_import_keeps_indexes(tree_db):
+	tree_db.set_fast_import(True)
+	assert CreateDatabase().missing_indexes(tree_db.conn) == []
+	tree_db.set_fast_import(False)
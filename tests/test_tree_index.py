@@ -0,0 +1,31 @@
+import pytest
+
+@pytest.mark.parametrize("closure", [False, True])
+def test_walk_matches_database_subtree(tree_db, closure):
+	if closure:
+		tree_db.build_closure()
+	index = tree_db.tree_index()
+	for maxdepth in (1,2,3,None):
+		expected = tree_db.get_children([1],maxdepth=maxdepth)
+		assert index.walk([1],maxdepth=maxdepth).nodes() == expected
+		assert set(index.iter_subtree([1],maxdepth=maxdepth)) == expected
+	assert index.walk([1],maxdepth=2).nodes() == {1,2,3,4}
+	assert tree_db.get_children([1],maxdepth=0) == set()
+	assert set(index.iter_subtree([1],maxdepth=0)) == set()
+	assert index.walk([2],maxdepth=0).nodes() == {2}
+
+@pytest.mark.parametrize("closure", [False, True])
+def test_lineage_matches_database(tree_db, closure):
+	if closure:
+		tree_db.build_closure()
+	index = tree_db.tree_index()
+	lineages = tree_db.get_lineages([2,3,4])
+	for node,lineage in lineages.items():
+		assert tuple(index.lineage(node)) == lineage
+	assert index.get_lca([4,2]) == tree_db.get_lca([4,2])
+
+def test_walk_up_reaches_all_parents(tree_db):
+	index = tree_db.tree_index()
+	assert index.walk([4],up=True).nodes() == {1,2,3,4}
+	assert index.walk([4],maxdepth=1,up=True).nodes() == {3,4}
+	assert index.walk([4],maxdepth=2,up=True).nodes() == {1,2,3,4}
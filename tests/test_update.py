@@ -0,0 +1,5 @@
+def test_upsert_genomes_counts_replaced_annotations(tree_db):
+	tree_db.add_genomes([("g1",2,None),("g2",3,None)])
+	added,updated = tree_db.upsert_genomes([("g1",2),("g2",4),("g3",4),("g3",3)])
+	assert (added,updated) == (1,1)
+	assert dict(tree_db.query("SELECT genome,id FROM genomes").fetchall()) == {"g1":2,"g2":4,"g3":3}
@@ -0,0 +1,22 @@
+import pytest
+
+from conftest import LINKS, build_database
+from flextaxd.modules.database.DatabaseConnection import TreeError
+
+def test_same_rank_multi_parent_is_fatal(tree_db):
+	with pytest.raises(TreeError):
+		tree_db.validate_tree()
+	assert tree_db.tree_report.rank_conflicts == [3]
+	assert not tree_db.tree_report
+
+def test_multi_parent_in_different_ranks_is_valid(tmp_path):
+	db = build_database(tmp_path / "tree.db", ranks={2:"genus",(2,3):"species",(1,3):"genus",4:"strain"})
+	assert db.validate_tree() is True
+	assert db.tree_report.multi_parents == [3]
+	assert db.tree_report.rank_conflicts == []
+
+def test_detached_node_is_fatal(tmp_path):
+	db = build_database(tmp_path / "tree.db", links=[link for link in LINKS if link != (1,3)] + [(5,6)])
+	with pytest.raises(TreeError):
+		db.validate_tree()
+	assert db.tree_report.orphans == [5,6]